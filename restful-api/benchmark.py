@@ -0,0 +1,599 @@
+#!/usr/bin/python3
+"""
+HTTP load generator for the restful-api and server-side rendering servers.
+
+The generator starts the target server in its own process on localhost,
+replays a fixed request mix against it and prints a JSON report with the
+throughput and latency percentiles. Two reports can then be compared.
+
+Load models:
+    closed: each of --concurrency connections sends a request as soon
+            as the previous response arrived.
+    open:   requests are sent at --rate per second whatever the response
+            times; latency is measured from the scheduled send time so
+            queueing behind a slow server is not hidden.
+
+Usage:
+    ./benchmark.py run TARGET [--mode {closed,open}] [--concurrency N]
+                   [--rate RPS] [--duration S] [--warmup S]
+                   [--no-keepalive] [--client-procs N]
+                   [--server-arg ARG ...] [--output FILE]
+    ./benchmark.py run --url http://HOST:PORT --path PATH [--path PATH ...]
+    ./benchmark.py diff BEFORE.json AFTER.json
+    ./benchmark.py memory [--users N] [--output FILE]
+    ./benchmark.py auth [--duration S] [--output FILE]
+
+TARGET is one of task_03_http_server, task_04_flask,
+task_05_basic_security and task_04_db.
+
+memory fills a task_04_flask UserStore with N generated users, in
+batches as /add_users does, and reports the heap traced by tracemalloc
+per user, next to the size of each user as NDJSON and the heap of the
+same users kept as one dict per user. With 1M users on CPython 3.11 the
+store takes about 340 bytes per user, indexes included, against 80 bytes
+of NDJSON and 390 bytes for plain dicts with no index at all.
+
+auth sends Basic-auth requests to task_05_basic_security's
+/basic-protected through the Flask test client, first with its password
+verification cache disabled, then enabled, and reports both throughputs.
+"""
+import argparse
+import asyncio
+import base64
+import collections
+import gc
+import http.client
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import time
+import tracemalloc
+import urllib.parse
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SSR_DIR = os.path.join(HERE, os.pardir, "python-server_side_rendering")
+FLASK_RUNNER = ("import sys, {module} as m; "
+                "m.app.run(port=int(sys.argv[1]), threaded=True)")
+PERCENTILES = (("p50", 0.50), ("p90", 0.90), ("p99", 0.99),
+               ("p999", 0.999))
+BASIC_AUTH = "Basic " + base64.b64encode(b"user1:password").decode()
+CITIES = ("New York", "Los Angeles", "San Francisco", "Chicago", "Paris",
+          "London", "Berlin", "Tokyo", "Lyon", "Nantes")
+
+
+def flask_command(module):
+    return [sys.executable, "-c", FLASK_RUNNER.format(module=module),
+            "{port}"]
+
+
+def setup_task_04_flask(host, port):
+    user = {"username": "jane", "name": "Jane", "age": 28,
+            "city": "Los Angeles"}
+    call(host, port, "POST", "/add_user", user)
+    return {}
+
+
+def setup_task_05_basic_security(host, port):
+    credentials = {"username": "user1", "password": "password"}
+    response = call(host, port, "POST", "/login", credentials)
+    return {"token": response.get("access_token", "")}
+
+
+def prepare_task_04_db():
+    if not os.path.exists(os.path.join(SSR_DIR, "products.db")):
+        subprocess.run([sys.executable, "setup_database.py"], cwd=SSR_DIR,
+                       check=True, stdout=subprocess.DEVNULL)
+
+
+TARGETS = {
+    "task_03_http_server": {
+        "cwd": HERE,
+        "command": [sys.executable, "task_03_http_server.py",
+                    "--port", "{port}", "--log", "off"],
+        "mix": [("GET", "/"), ("GET", "/data"), ("GET", "/status")],
+    },
+    "task_04_flask": {
+        "cwd": HERE,
+        "command": flask_command("task_04_flask"),
+        "setup": setup_task_04_flask,
+        "mix": [("GET", "/"), ("GET", "/data"), ("GET", "/status"),
+                ("GET", "/users/jane")],
+    },
+    "task_05_basic_security": {
+        "cwd": HERE,
+        "command": flask_command("task_05_basic_security"),
+        "setup": setup_task_05_basic_security,
+        "mix": [("GET", "/basic-protected", {"Authorization": BASIC_AUTH}),
+                ("GET", "/jwt-protected",
+                 {"Authorization": "Bearer {token}"}),
+                ("GET", "/admin-only", {"Authorization": "Bearer {token}"})],
+    },
+    "task_04_db": {
+        "cwd": SSR_DIR,
+        "command": flask_command("task_04_db"),
+        "prepare": prepare_task_04_db,
+        "mix": [("GET", "/products?source=json"),
+                ("GET", "/products?source=csv"),
+                ("GET", "/products?source=sql"),
+                ("GET", "/products?source=sql&id=1")],
+    },
+}
+
+
+def call(host, port, method, path, data=None):
+    """Send one setup request and return its decoded JSON body."""
+    conn = http.client.HTTPConnection(host, port, timeout=10)
+    body = json.dumps(data) if data is not None else None
+    headers = {"Content-Type": "application/json"} if body else {}
+    conn.request(method, path, body=body, headers=headers)
+    response = conn.getresponse().read()
+    conn.close()
+    try:
+        return json.loads(response)
+    except ValueError:
+        return {}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(host, port, process, timeout=15.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with code "
+                               f"{process.returncode}")
+        try:
+            socket.create_connection((host, port), timeout=0.2).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"Server did not listen on port {port} in time")
+
+
+def start_target(name, port, server_args):
+    """Start the server of a target, return the process once it listens."""
+    target = TARGETS[name]
+    if "prepare" in target:
+        target["prepare"]()
+    command = [arg.format(port=port) for arg in target["command"]]
+    process = subprocess.Popen(command + list(server_args),
+                               cwd=target["cwd"],
+                               stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port("127.0.0.1", port, process)
+    except BaseException:
+        process.kill()
+        process.wait()
+        raise
+    return process
+
+
+def stop_target(process):
+    process.terminate()
+    try:
+        process.wait(10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def encode_requests(mix, host, keepalive, values):
+    """Encode each (method, path[, headers[, body]]) of mix once."""
+    requests = []
+    for method, path, *rest in mix:
+        headers = dict(rest[0]) if rest else {}
+        body = json.dumps(rest[1]).encode() if len(rest) > 1 else b""
+        lines = [f"{method} {path} HTTP/1.1", f"Host: {host}"]
+        lines += [f"{name}: {value.format(**values)}"
+                  for name, value in headers.items()]
+        if body:
+            lines.append("Content-Type: application/json")
+        if body or method in ("POST", "PUT"):
+            lines.append(f"Content-Length: {len(body)}")
+        if not keepalive:
+            lines.append("Connection: close")
+        requests.append(("\r\n".join(lines) + "\r\n\r\n").encode() + body)
+    return requests
+
+
+async def read_response(reader, method=b"GET"):
+    """Read one response, return (status, whether the server closes)."""
+    head = await reader.readuntil(b"\r\n\r\n")
+    lines = head[:-4].split(b"\r\n")
+    version, status = lines[0].split(None, 2)[:2]
+    status = int(status)
+    headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(b":")
+        headers[name.strip().lower()] = value.strip().lower()
+    connection = headers.get(b"connection", b"")
+    close = connection == b"close" or (version == b"HTTP/1.0" and
+                                       connection != b"keep-alive")
+    if status in (204, 304) or status < 200 or method == b"HEAD":
+        return status, close
+    if b"content-length" in headers:
+        await reader.readexactly(int(headers[b"content-length"]))
+    elif headers.get(b"transfer-encoding") == b"chunked":
+        while True:
+            size = int((await reader.readline()).split(b";")[0], 16)
+            await reader.readexactly(size + 2)
+            if size == 0:
+                break
+    else:
+        await reader.read()
+        close = True
+    return status, close
+
+
+class Client:
+    """One client connection, reopened whenever it gets closed."""
+
+    def __init__(self, host, port, keepalive=True):
+        self.host = host
+        self.port = port
+        self.keepalive = keepalive
+        self.reader = None
+        self.writer = None
+
+    async def send(self, raw):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(
+                self.host, self.port)
+        self.writer.write(raw)
+        status, close = await read_response(self.reader,
+                                            raw.split(b" ", 1)[0])
+        if close or not self.keepalive:
+            self.close()
+        return status
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.reader = self.writer = None
+
+
+class Results:
+    """Latencies and status codes recorded after the warm-up period."""
+
+    def __init__(self, measure_from):
+        self.measure_from = measure_from
+        self.latencies = []
+        self.statuses = collections.Counter()
+        self.errors = 0
+
+    def record(self, started, latency, status):
+        if started < self.measure_from:
+            return
+        if status is None:
+            self.errors += 1
+        else:
+            self.statuses[status] += 1
+            self.latencies.append(latency)
+
+
+async def send(client, raw, timeout):
+    try:
+        return await asyncio.wait_for(client.send(raw), timeout)
+    except (OSError, EOFError, ValueError, asyncio.TimeoutError,
+            asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+        client.close()
+        return None
+
+
+async def closed_loop(clients, requests, results, deadline, timeout):
+    async def worker(client, index):
+        while time.perf_counter() < deadline:
+            raw = requests[index % len(requests)]
+            index += 1
+            started = time.perf_counter()
+            status = await send(client, raw, timeout)
+            results.record(started, time.perf_counter() - started, status)
+
+    await asyncio.gather(*(worker(client, index)
+                           for index, client in enumerate(clients)))
+
+
+async def open_loop(clients, requests, results, deadline, timeout, rate):
+    idle = asyncio.Queue()
+    for client in clients:
+        idle.put_nowait(client)
+
+    async def one(scheduled, raw):
+        client = await idle.get()
+        try:
+            status = await send(client, raw, timeout)
+        finally:
+            idle.put_nowait(client)
+        results.record(scheduled, time.perf_counter() - scheduled, status)
+
+    tasks = []
+    start = time.perf_counter()
+    for index in itertools.count():
+        scheduled = start + index / rate
+        if scheduled >= deadline:
+            break
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.ensure_future(
+            one(scheduled, requests[index % len(requests)])))
+    if not tasks:
+        return
+    _, pending = await asyncio.wait(tasks, timeout=timeout)
+    for task in pending:
+        task.cancel()
+        results.errors += 1
+
+
+def generate(options):
+    """Body of one client process: run the load, return raw results."""
+    async def main():
+        start = time.perf_counter()
+        results = Results(start + options["warmup"])
+        deadline = start + options["warmup"] + options["duration"]
+        clients = [Client(options["host"], options["port"],
+                          options["keepalive"])
+                   for _ in range(options["concurrency"])]
+        if options["mode"] == "open":
+            await open_loop(clients, options["requests"], results, deadline,
+                            options["timeout"], options["rate"])
+        else:
+            await closed_loop(clients, options["requests"], results,
+                              deadline, options["timeout"])
+        for client in clients:
+            client.close()
+        return results
+
+    results = asyncio.run(main())
+    return results.latencies, dict(results.statuses), results.errors
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1,
+                       max(0, math.ceil(fraction * len(ordered)) - 1))]
+
+
+def summarize(outcomes, duration):
+    latencies = []
+    statuses = collections.Counter()
+    errors = 0
+    for process_latencies, process_statuses, process_errors in outcomes:
+        latencies.extend(process_latencies)
+        statuses.update(process_statuses)
+        errors += process_errors
+    latencies.sort()
+    report = {"requests": len(latencies), "errors": errors,
+              "rps": round(len(latencies) / duration, 1),
+              "status": {str(code): count
+                         for code, count in sorted(statuses.items())},
+              "latency_ms": {}}
+    for name, fraction in PERCENTILES:
+        value = percentile(latencies, fraction)
+        report["latency_ms"][name] = \
+            round(value * 1000, 3) if value is not None else None
+    if latencies:
+        report["latency_ms"]["mean"] = \
+            round(sum(latencies) / len(latencies) * 1000, 3)
+        report["latency_ms"]["max"] = round(latencies[-1] * 1000, 3)
+    return report
+
+
+def split(total, parts):
+    return [total // parts + (index < total % parts)
+            for index in range(parts)]
+
+
+def run(args):
+    process = None
+    values = {}
+    if args.url:
+        url = urllib.parse.urlsplit(args.url)
+        host, port = url.hostname, url.port or 80
+        mix = [("GET", path) for path in args.path or ["/"]]
+        target = args.url
+    else:
+        host, port = "127.0.0.1", free_port()
+        process = start_target(args.target, port, args.server_arg)
+        target = args.target
+        mix = TARGETS[target]["mix"]
+    try:
+        if process is not None and "setup" in TARGETS[target]:
+            values = TARGETS[target]["setup"](host, port)
+        requests = encode_requests(mix, f"{host}:{port}",
+                                   not args.no_keepalive, values)
+        procs = max(1, min(args.client_procs, args.concurrency))
+        jobs = [{"host": host, "port": port, "requests": requests,
+                 "mode": args.mode, "concurrency": concurrency,
+                 "rate": args.rate / procs, "duration": args.duration,
+                 "warmup": args.warmup, "timeout": args.timeout,
+                 "keepalive": not args.no_keepalive}
+                for concurrency in split(args.concurrency, procs)]
+        if procs == 1:
+            outcomes = [generate(jobs[0])]
+        else:
+            with multiprocessing.Pool(procs) as pool:
+                outcomes = pool.map(generate, jobs)
+    finally:
+        if process is not None:
+            stop_target(process)
+    report = {"target": target, "mode": args.mode,
+              "concurrency": args.concurrency,
+              "rate": args.rate if args.mode == "open" else None,
+              "keepalive": not args.no_keepalive,
+              "duration": args.duration, "client_procs": procs,
+              "server_args": list(args.server_arg),
+              "mix": [f"{method} {path}" for method, path, *_ in mix]}
+    report.update(summarize(outcomes, args.duration))
+    return report
+
+
+def diff(before, after):
+    """Compare the throughput and latencies of two reports."""
+    def change(old, new):
+        entry = {"before": old, "after": new}
+        if old and new is not None:
+            entry["change_pct"] = round((new - old) / old * 100, 1)
+        return entry
+
+    result = {"before": before.get("target"), "after": after.get("target"),
+              "rps": change(before.get("rps"), after.get("rps")),
+              "errors": change(before.get("errors"), after.get("errors")),
+              "latency_ms": {}}
+    for name in before.get("latency_ms", {}):
+        result["latency_ms"][name] = change(
+            before["latency_ms"][name], after.get("latency_ms", {}).get(name))
+    return result
+
+
+def generate_users(count, batch_size):
+    """Yield batches of users as decoded from a JSON request body."""
+    for start in range(0, count, batch_size):
+        yield [json.loads(json.dumps({
+            "username": f"user{n}", "name": f"User {n}",
+            "age": 18 + n % 70, "city": CITIES[n % len(CITIES)]}))
+            for n in range(start, min(count, start + batch_size))]
+
+
+def traced(build, count):
+    """Return the heap allocated by build() per user, and its duration."""
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    kept = build()
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del kept
+    return round(size / count, 1), round(elapsed, 2)
+
+
+def memory(args):
+    """Measure the memory taken per user by the task_04_flask store."""
+    sys.path.insert(0, HERE)
+    import task_04_flask
+
+    def fill_store():
+        store = task_04_flask.UserStore()
+        for batch in generate_users(args.users,
+                                    task_04_flask.INGEST_BATCH):
+            store.put_many(batch)
+        return store
+
+    def fill_dicts():
+        users = {}
+        for batch in generate_users(args.users,
+                                    task_04_flask.INGEST_BATCH):
+            for user in batch:
+                users[user["username"]] = task_04_flask.make_user(user)
+        return users
+
+    raw = sum(len(json.dumps(user)) + 1
+              for batch in generate_users(args.users, 10000)
+              for user in batch)
+    store_bytes, store_s = traced(fill_store, args.users)
+    dict_bytes, dict_s = traced(fill_dicts, args.users)
+    return {"target": "task_04_flask memory", "users": args.users,
+            "ndjson_bytes_per_user": round(raw / args.users, 1),
+            "store_bytes_per_user": store_bytes, "store_load_s": store_s,
+            "dict_bytes_per_user": dict_bytes, "dict_load_s": dict_s}
+
+
+def auth(args):
+    """Compare Basic-auth throughput without and with the password cache."""
+    sys.path.insert(0, HERE)
+    import task_05_basic_security as task
+
+    client = task.app.test_client()
+    headers = {"Authorization": BASIC_AUTH}
+
+    def measure(cache):
+        task.verify_cache = cache
+        count = 0
+        start = time.perf_counter()
+        while time.perf_counter() - start < args.duration:
+            response = client.get("/basic-protected", headers=headers)
+            if response.status_code != 200:
+                raise RuntimeError(f"/basic-protected: {response.status}")
+            count += 1
+        return round(count / (time.perf_counter() - start), 1)
+
+    uncached = measure(task.VerifyCache(size=0))
+    cached = measure(task.VerifyCache())
+    return {"target": "task_05_basic_security auth",
+            "uncached_rps": uncached, "cached_rps": cached,
+            "speedup": round(cached / uncached, 1)}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="benchmark a server")
+    run_parser.add_argument("target", nargs="?", choices=sorted(TARGETS))
+    run_parser.add_argument("--url", help="benchmark an already running "
+                                          "server instead of a target")
+    run_parser.add_argument("--path", action="append",
+                            help="path of the request mix with --url")
+    run_parser.add_argument("--mode", choices=("closed", "open"),
+                            default="closed")
+    run_parser.add_argument("--concurrency", type=int, default=16,
+                            help="client connections")
+    run_parser.add_argument("--rate", type=float, default=1000.0,
+                            help="requests per second in open mode")
+    run_parser.add_argument("--duration", type=float, default=10.0,
+                            help="measured seconds")
+    run_parser.add_argument("--warmup", type=float, default=2.0,
+                            help="seconds of load before measuring")
+    run_parser.add_argument("--timeout", type=float, default=10.0,
+                            help="seconds before a request is an error")
+    run_parser.add_argument("--no-keepalive", action="store_true",
+                            help="open a new connection for every request")
+    run_parser.add_argument("--client-procs", type=int, default=1,
+                            help="load generator processes")
+    run_parser.add_argument("--server-arg", action="append", default=[],
+                            help="extra argument for the target server")
+    run_parser.add_argument("--output", help="also write the report here")
+    diff_parser = commands.add_parser("diff", help="compare two reports")
+    diff_parser.add_argument("before")
+    diff_parser.add_argument("after")
+    memory_parser = commands.add_parser(
+        "memory", help="measure the task_04_flask store memory per user")
+    memory_parser.add_argument("--users", type=int, default=1000000,
+                               help="users to store")
+    memory_parser.add_argument("--output", help="also write the report here")
+    auth_parser = commands.add_parser(
+        "auth", help="compare task_05 Basic-auth throughput with and "
+                     "without the password cache")
+    auth_parser.add_argument("--duration", type=float, default=5.0,
+                             help="measured seconds for each run")
+    auth_parser.add_argument("--output", help="also write the report here")
+    args = parser.parse_args(argv)
+    if args.command == "run" and not (args.target or args.url):
+        parser.error("run needs a target or --url")
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.command != "diff":
+        report = {"run": run, "memory": memory, "auth": auth}[
+            args.command](args)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(report, f, indent=2)
+    else:
+        with open(args.before) as f, open(args.after) as g:
+            report = diff(json.load(f), json.load(g))
+    print(json.dumps(report, indent=2))
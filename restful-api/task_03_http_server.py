@@ -1,33 +1,1515 @@
-import http.server
-import socketserver
-import json
-PORT = 8000
-class RequestHandler(http.server.BaseHTTPRequestHandler):
-    def do_GET(self):
-        if self.path == "/":
-            self.send_response(200)
-            self.send_header("Content-type", "text/plain")
-            self.end_headers()
-            self.wfile.write(b"Hello, this is a simple API!")
-        elif self.path == "/data":
-            data = {"name": "John", "age": 30, "city": "New York"}
-            self.send_response(200)
-            self.send_header("Content-type", "application/json")
-            self.end_headers()
-            self.wfile.write(json.dumps(data).encode())
-        elif self.path == "/status":
-            self.send_response(200)
-            self.send_header("Content-type", "text/plain")
-            self.end_headers()
-            self.wfile.write(b"OK")
-        else:
-            self.send_response(404)
-            self.send_header("Content-type", "text/plain")
-            self.end_headers()
-            self.wfile.write(b"Endpoint not found")
-with socketserver.TCPServer(("", PORT), RequestHandler) as httpd:
-    print(f"Serving on port {PORT}")
-    httpd.serve_forever()
-
-if __name__ == "__main__":
-    run_server()
+#!/usr/bin/python3
+"""
+Simple API built on the standard library http.server module.
+
+The API can be served in one of three concurrency modes:
+    threaded: accepted connections are handed to a bounded pool of
+              worker threads, extra connections wait in a bounded queue.
+              A worker is only held while a request is being served:
+              idle keep-alive connections wait in a selector, so
+              --workers bounds concurrent requests, not open connections.
+    selector: a single thread multiplexes every connection with selectors.
+    asyncio:  every connection is a task of an asyncio event loop, suited
+              to many mostly idle long-poll connections.
+All modes send byte for byte the same responses.
+
+Connections are kept alive (HTTP/1.1) and may carry pipelined requests.
+With --processes N, a supervisor pre-forks N worker processes sharing the
+port, restarts the ones that crash and stops them all on SIGTERM.
+Large enough bodies are sent gzip or deflate compressed when the client
+accepts it. Successful responses carry ETag and Last-Modified validators,
+conditional requests that still match get an empty 304 Not Modified.
+Files of --static-dir (by default the javascript-dom_manipulation project)
+are served under /static/ with sendfile() and Range support.
+/metrics exposes request counts and latency histograms of the serving
+process in the Prometheus text format. /batch answers several routes in
+one JSON envelope, from GET /batch?path=/data&path=/status (or
+?paths=/data,/status) or POST /batch with a JSON list of paths.
+
+Usage:
+    ./task_03_http_server.py [--port PORT]
+                             [--mode {threaded,selector,asyncio}]
+                             [--workers N] [--queue-size N]
+                             [--idle-timeout SECONDS] [--max-requests N]
+                             [--processes N] [--static-dir DIR]
+                             [--log {sync,async,off}]
+"""
+import argparse
+import asyncio
+import bisect
+import collections
+import email.utils
+import errno
+import functools
+import hashlib
+import http
+import http.server
+import io
+import itertools
+import json
+import mimetypes
+import os
+import queue
+import selectors
+import signal
+import socket
+import socketserver
+import stat
+import sys
+import threading
+import time
+import traceback
+import urllib.parse
+import zlib
+
+PORT = 8000
+MODES = ("threaded", "selector", "asyncio")
+LOG_MODES = ("sync", "async", "off")
+METRICS_PATH = "/metrics"
+METRICS_TYPE = "text/plain; version=0.0.4"
+BATCH_PATH = "/batch"
+ENCODINGS = ("gzip", "deflate")
+COMPRESSIBLE_TYPES = ("text/", "application/json", "application/javascript")
+STATIC_PREFIX = "/static/"
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          os.pardir, "javascript-dom_manipulation")
+SEND_CHUNK = 1 << 20
+SENDFILE_UNSUPPORTED = (errno.EINVAL, errno.ENOSYS, errno.ENOTSOCK,
+                        errno.EOPNOTSUPP)
+CONTROL_CHARS = str.maketrans({
+    c: fr"\x{c:02x}" for c in itertools.chain(range(0x20), range(0x7f, 0xa0))})
+BUSY_RESPONSE = (b"HTTP/1.1 503 Service Unavailable\r\n"
+                 b"Content-type: text/plain\r\n"
+                 b"Content-Length: 11\r\n"
+                 b"Connection: close\r\n"
+                 b"Retry-After: 1\r\n\r\n"
+                 b"Server busy")
+
+
+def normalize_path(path):
+    """Strip the query string, fragment and trailing slash of a path."""
+    path = path.split("?", 1)[0].split("#", 1)[0]
+    return path.rstrip("/") or "/"
+
+
+_date_cache = [0, b""]
+
+
+def http_date():
+    """Return the Date header value, formatted at most once per second."""
+    now = int(time.time())
+    if _date_cache[0] != now:
+        _date_cache[1] = email.utils.formatdate(now, usegmt=True).encode()
+        _date_cache[0] = now
+    return _date_cache[1]
+
+
+@functools.lru_cache(maxsize=256)
+def negotiate_encoding(accept_encoding):
+    """
+    Pick the content coding to use for an Accept-Encoding header value.
+
+    Returns "gzip", "deflate" or None for the identity coding. Clients
+    send the same few header values over and over, so results are cached.
+    """
+    if not accept_encoding:
+        return None
+    weights = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.partition(";")
+        weight = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key.lower() == "q":
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+        weights[name.strip().lower()] = weight
+    best, best_weight = None, 0.0
+    for encoding in ENCODINGS:
+        weight = weights.get(encoding, weights.get("*", 0.0))
+        if weight > best_weight:
+            best, best_weight = encoding, weight
+    return best
+
+
+@functools.lru_cache(maxsize=None)
+def status_line(status):
+    phrase = http.HTTPStatus(status).phrase
+    return f"HTTP/1.1 {status} {phrase}\r\n".encode()
+
+
+def not_modified(etag, modified, if_none_match, if_modified_since):
+    """Tell whether conditional request headers allow a 304 response."""
+    if etag is None:
+        return False
+    if if_none_match is not None:
+        for tag in if_none_match.split(","):
+            tag = tag.strip()
+            if tag == "*" or tag.removeprefix("W/") == etag:
+                return True
+        return False
+    if if_modified_since is not None:
+        try:
+            since = email.utils.parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        return modified <= since.timestamp()
+    return False
+
+
+def content_length(value):
+    """Parse a Content-Length value, None when it is not a valid length."""
+    value = value.strip()
+    if not (value.isascii() and value.isdigit()):
+        return None
+    return int(value)
+
+
+def compress(body, encoding):
+    if encoding == "gzip":
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        return compressor.compress(body) + compressor.flush()
+    return zlib.compress(body, 6)
+
+
+class Route:
+    """
+    Pre-rendered response of a static endpoint.
+
+    The status line, entity headers and body are encoded once when the
+    route is built, serving it only prepends the per-request headers.
+    Bodies of at least min_compress_size bytes with a textual content
+    type are also served gzip or deflate compressed; each compressed
+    variant is computed on first use and kept with the route.
+    Successful routes carry a strong ETag, derived from the body of each
+    variant, and a Last-Modified date set when the route is built, unless
+    built with cacheable false for a body computed per request.
+    Routes are immutable: changing a payload means building a new Route,
+    which also drops the compressed variants and validators of the old
+    payload.
+    """
+    __slots__ = ("status", "content_type", "status_line", "body",
+                 "compressible", "modified", "last_modified", "identity",
+                 "variants", "batch_fields", "cacheable")
+    min_compress_size = 256
+
+    def __init__(self, status, content_type, body, cacheable=True):
+        self.status = status
+        self.content_type = content_type
+        self.body = body
+        self.cacheable = cacheable
+        self.status_line = status_line(status)
+        self.compressible = (len(body) >= self.min_compress_size and
+                             content_type.startswith(COMPRESSIBLE_TYPES))
+        self.modified = int(time.time())
+        self.last_modified = email.utils.formatdate(self.modified,
+                                                    usegmt=True)
+        self.identity = self.build_variant(body)
+        self.variants = {}
+        self.batch_fields = None
+
+    @classmethod
+    def json(cls, data, status=200):
+        return cls(status, "application/json", json.dumps(data).encode())
+
+    @property
+    def headers(self):
+        return self.identity[0]
+
+    def build_variant(self, body, encoding=None):
+        """
+        Return the (headers, body, etag, validators) of one variant.
+
+        validators holds the header lines repeated in a 304 response.
+        """
+        etag = None
+        validators = ""
+        if self.status == 200 and self.cacheable:
+            digest = hashlib.blake2b(body, digest_size=12).hexdigest()
+            etag = f'"{digest}"'
+            validators = (f"ETag: {etag}\r\n"
+                          f"Last-Modified: {self.last_modified}\r\n")
+        if self.compressible:
+            validators += "Vary: Accept-Encoding\r\n"
+        headers = (f"Content-type: {self.content_type}\r\n"
+                   f"Content-Length: {len(body)}\r\n")
+        if encoding:
+            headers += f"Content-Encoding: {encoding}\r\n"
+        headers += validators
+        return headers.encode(), body, etag, validators.encode()
+
+    def variant(self, encoding):
+        """Return the variant to send for a content coding."""
+        if encoding is None or not self.compressible:
+            return self.identity
+        variant = self.variants.get(encoding)
+        if variant is None:
+            body = compress(self.body, encoding)
+            if len(body) < len(self.body):
+                variant = self.build_variant(body, encoding)
+            else:
+                variant = self.identity
+            self.variants[encoding] = variant
+        return variant
+
+    def batch_entry(self, path):
+        """
+        Return the JSON object describing this route in a /batch response.
+
+        JSON bodies are embedded as is, other bodies as a string; the
+        encoded fields are computed once per route.
+        """
+        if self.batch_fields is None:
+            if self.content_type == "application/json":
+                body = self.body
+            else:
+                body = json.dumps(self.body.decode("utf-8", "replace"))
+                body = body.encode()
+            self.batch_fields = (f', "status": {self.status}, '
+                                 f'"content_type": "{self.content_type}", '
+                                 f'"body": ').encode() + body + b"}"
+        return b'{"path": ' + json.dumps(path).encode() + self.batch_fields
+
+    def not_modified(self, etag, if_none_match, if_modified_since):
+        return not_modified(etag, self.modified, if_none_match,
+                            if_modified_since)
+
+
+class RouteTable:
+    """
+    Map of normalized paths to pre-rendered routes.
+
+    Lookups are a single dict access. register() and set_json() can be
+    called at runtime from any thread: the new route replaces the old one
+    in one assignment, so readers see either the old or the new payload.
+    """
+
+    def __init__(self):
+        self.routes = {}
+
+    def register(self, path, body, content_type="text/plain", status=200):
+        route = Route(status, content_type, body)
+        self.routes[normalize_path(path)] = route
+        return route
+
+    def set_json(self, path, data, status=200):
+        route = Route.json(data, status)
+        self.routes[normalize_path(path)] = route
+        return route
+
+    def unregister(self, path):
+        self.routes.pop(normalize_path(path), None)
+
+    def lookup(self, path):
+        return self.routes.get(normalize_path(path))
+
+
+NOT_FOUND = Route(404, "text/plain", b"Endpoint not found")
+ROUTES = RouteTable()
+ROUTES.register("/", b"Hello, this is a simple API!")
+ROUTES.set_json("/data", {"name": "John", "age": 30, "city": "New York"})
+ROUTES.register("/status", b"OK")
+
+
+def parse_range(header, size):
+    """
+    Parse a Range header against a file of size bytes.
+
+    Returns the (first, last) byte positions of a single byte range,
+    None when the header should be ignored (unsupported or multiple
+    ranges) and False when the range cannot be satisfied.
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, dash, last = spec.strip().partition("-")
+    if not dash:
+        return None
+    try:
+        if not first:
+            length = int(last)
+            if length <= 0 or size == 0:
+                return False
+            return max(size - length, 0), size - 1
+        first = int(first)
+        last = int(last) if last else None
+    except ValueError:
+        return None
+    if last is not None and last < first:
+        return None
+    if first >= size:
+        return False
+    if last is None:
+        return first, size - 1
+    return first, min(last, size - 1)
+
+
+class StaticFile:
+    """Open file of the static directory with its stat results."""
+    __slots__ = ("path", "file", "fd", "size", "ino", "mtime_ns", "modified",
+                 "etag", "last_modified", "content_type", "checked")
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb", buffering=0)
+        self.fd = self.file.fileno()
+        st = os.fstat(self.fd)
+        if not stat.S_ISREG(st.st_mode):
+            raise IsADirectoryError(path)
+        self.size = st.st_size
+        self.ino = st.st_ino
+        self.mtime_ns = st.st_mtime_ns
+        self.modified = int(st.st_mtime)
+        self.etag = f'"{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}"'
+        self.last_modified = email.utils.formatdate(self.modified,
+                                                    usegmt=True)
+        self.content_type = (mimetypes.guess_type(path)[0] or
+                             "application/octet-stream")
+        self.checked = time.monotonic()
+
+    def __del__(self):
+        try:
+            self.file.close()
+        except AttributeError:
+            pass
+
+    def changed(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return True
+        return (st.st_ino, st.st_size, st.st_mtime_ns) != \
+            (self.ino, self.size, self.mtime_ns)
+
+
+class StaticFiles:
+    """
+    Files of a directory, served under /static/.
+
+    Open files and their stat results are kept in an LRU cache of at most
+    max_open entries and re-checked against the disk at most once every
+    stat_interval seconds. An evicted file is closed once the last
+    response still sending it lets go of it.
+    """
+
+    def __init__(self, root, max_open=256, stat_interval=1.0):
+        self.root = os.path.realpath(root)
+        self.max_open = max_open
+        self.stat_interval = stat_interval
+        self.files = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def resolve(self, name):
+        """Return the real path of name if it lies inside root."""
+        try:
+            path = os.path.realpath(os.path.join(self.root,
+                                                 urllib.parse.unquote(name)))
+        except ValueError:
+            # An embedded NUL byte cannot name a file
+            return None
+        if os.path.commonpath([self.root, path]) != self.root:
+            return None
+        return path
+
+    def get(self, name):
+        """Return the StaticFile for a name relative to root, or None."""
+        with self.lock:
+            entry = self.files.get(name)
+            if entry is not None:
+                self.files.move_to_end(name)
+        now = time.monotonic()
+        if entry is not None:
+            if now - entry.checked < self.stat_interval:
+                return entry
+            if not entry.changed():
+                entry.checked = now
+                return entry
+        path = self.resolve(name)
+        try:
+            entry = StaticFile(path) if path else None
+        except (OSError, ValueError):
+            entry = None
+        with self.lock:
+            if entry is None:
+                self.files.pop(name, None)
+                return None
+            self.files[name] = entry
+            while len(self.files) > self.max_open:
+                self.files.popitem(last=False)
+        return entry
+
+
+class FileSegment:
+    """
+    Byte range of a StaticFile still to be written to a socket.
+
+    Uses os.sendfile() when available and falls back to pread() and
+    send() of SEND_CHUNK sized chunks otherwise. Positional reads leave
+    the shared file offset alone, so one open file can be sent to many
+    connections at once.
+    """
+    __slots__ = ("file", "offset", "count")
+    use_sendfile = hasattr(os, "sendfile")
+
+    def __init__(self, file, offset, count):
+        self.file = file
+        self.offset = offset
+        self.count = count
+
+    def send(self, sock):
+        """Send the next chunk, raises BlockingIOError if sock is full."""
+        size = min(self.count, SEND_CHUNK)
+        if FileSegment.use_sendfile:
+            try:
+                sent = os.sendfile(sock.fileno(), self.file.fd, self.offset,
+                                   size)
+            except OSError as e:
+                if e.errno not in SENDFILE_UNSUPPORTED:
+                    raise
+                FileSegment.use_sendfile = False
+                return self.send(sock)
+        else:
+            sent = sock.send(os.pread(self.file.fd, size, self.offset))
+        if sent == 0:
+            raise OSError(errno.EIO, "static file shrank while sending")
+        self.offset += sent
+        self.count -= sent
+
+
+def wait_writable(sock, timeout):
+    with selectors.DefaultSelector() as selector:
+        selector.register(sock, selectors.EVENT_WRITE)
+        if not selector.select(timeout):
+            raise TimeoutError("timed out sending file")
+
+
+class Metrics:
+    """
+    Request metrics of one server process.
+
+    Counts requests by path and status code, tracks the requests being
+    served and keeps a latency histogram per path, with buckets growing by
+    powers of two from 100µs. Requests that got no response, like the
+    ones timing out, only leave the in-flight gauge. render() formats
+    everything in the Prometheus text exposition format.
+    """
+    bounds = tuple(0.0001 * 2 ** i for i in range(18))
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.requests = collections.Counter()
+        self.histograms = {}
+
+    def begin(self):
+        with self.lock:
+            self.in_flight += 1
+
+    def end(self, path, status, duration):
+        index = bisect.bisect_left(self.bounds, duration)
+        with self.lock:
+            self.in_flight -= 1
+            if status is None:
+                return
+            self.requests[path, status] += 1
+            histogram = self.histograms.get(path)
+            if histogram is None:
+                histogram = self.histograms[path] = \
+                    [[0] * (len(self.bounds) + 1), 0.0]
+            histogram[0][index] += 1
+            histogram[1] += duration
+
+    def render(self):
+        with self.lock:
+            in_flight = self.in_flight
+            requests = sorted(self.requests.items())
+            histograms = sorted((path, list(counts), total)
+                                for path, (counts, total)
+                                in self.histograms.items())
+        lines = ["# HELP http_requests_total Requests served.",
+                 "# TYPE http_requests_total counter"]
+        for (path, status), count in requests:
+            lines.append(f'http_requests_total{{path="{path}",'
+                         f'code="{status}"}} {count}')
+        lines += ["# HELP http_requests_in_flight Requests being served.",
+                  "# TYPE http_requests_in_flight gauge",
+                  f"http_requests_in_flight {in_flight}",
+                  "# HELP http_request_duration_seconds Request latency.",
+                  "# TYPE http_request_duration_seconds histogram"]
+        for path, counts, total in histograms:
+            cumulative = 0
+            for bound, count in zip(self.bounds + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                lines.append(f'http_request_duration_seconds_bucket'
+                             f'{{path="{path}",le="{le}"}} {cumulative}')
+            lines.append(f'http_request_duration_seconds_sum'
+                         f'{{path="{path}"}} {total:.6f}')
+            lines.append(f'http_request_duration_seconds_count'
+                         f'{{path="{path}"}} {cumulative}')
+        return ("\n".join(lines) + "\n").encode()
+
+
+class AsyncLogWriter:
+    """
+    Access log writer moving the writes off the request path.
+
+    Lines are queued and a background thread writes them to stream in
+    batches of whatever accumulated since the previous write.
+    """
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stderr
+        self.lines = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def __call__(self, line):
+        self.lines.put(line)
+
+    def run(self):
+        while True:
+            batch = [self.lines.get()]
+            while True:
+                try:
+                    batch.append(self.lines.get_nowait())
+                except queue.Empty:
+                    break
+            self.stream.write("".join(batch))
+            self.stream.flush()
+
+
+def write_stderr(line):
+    sys.stderr.write(line)
+
+
+def make_log_writer(log):
+    """Return the access log writer for a LOG_MODES value."""
+    if log == "sync":
+        return write_stderr
+    if log == "async":
+        return AsyncLogWriter()
+    if log == "off":
+        return None
+    raise ValueError(f"Unknown log mode {log!r}, expected one of {LOG_MODES}")
+
+
+METRICS = Metrics()
+
+
+class RequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    HTTP/1.1 handler keeping connections open between requests.
+
+    Every response carries a Content-Length so clients can reuse the
+    connection, idle connections are dropped after timeout seconds and a
+    connection is closed after max_requests responses. Request bodies are
+    read whatever the method, so they never run into the next request;
+    bodies without a Content-Length, like chunked ones, are refused with
+    411 and the connection is closed. Responses come
+    from the routes table and are sent with a single write; files under
+    /static/ are sent straight from the page cache with sendfile().
+    Every request is recorded in metrics, served at /metrics, and logged
+    through the log_writer of the server.
+    """
+    protocol_version = "HTTP/1.1"
+    timeout = 5.0
+    max_requests = 100
+    routes = ROUTES
+    metrics = METRICS
+    max_body_size = 65536
+    max_batch_paths = 32
+    log_writer = staticmethod(write_stderr)
+    deferred = None
+
+    def setup(self):
+        # An idle_timeout of 0 means no timeout, as in the other modes,
+        # not a non-blocking socket
+        self.timeout = getattr(self.server, "idle_timeout",
+                               self.timeout) or None
+        self.max_requests = getattr(self.server, "max_requests",
+                                    self.max_requests)
+        served = getattr(self.server, "served", None)
+        self.requests_served = served.pop(self.request, 0) \
+            if served is not None else 0
+        self.parked = False
+        super().setup()
+
+    def handle(self):
+        # With a server able to park connections, stop once the next
+        # request is not already buffered: the server waits for it in a
+        # selector instead of this thread
+        can_park = hasattr(self.server, "park")
+        self.handle_one_request()
+        while not self.close_connection:
+            if can_park and not self.buffered():
+                self.parked = True
+                return
+            self.handle_one_request()
+
+    def buffered(self):
+        """Whether bytes of the next request are already read."""
+        self.connection.settimeout(0)
+        try:
+            return bool(self.rfile.peek(1))
+        except OSError:
+            return False
+        finally:
+            self.connection.settimeout(self.timeout)
+
+    def handle_one_request(self):
+        self.requests_served += 1
+        self.started = None
+        self.response_status = None
+        self.metrics_path = "other"
+        try:
+            super().handle_one_request()
+        finally:
+            if self.started is not None:
+                self.metrics.end(self.metrics_path, self.response_status,
+                                 time.perf_counter() - self.started)
+
+    def parse_request(self):
+        self.started = time.perf_counter()
+        self.metrics.begin()
+        return super().parse_request() and self.read_body()
+
+    def read_body(self):
+        """Read the request body, or answer why it cannot be read."""
+        self.body = b""
+        if "Transfer-Encoding" in self.headers:
+            # Without a length the end of the body cannot be found
+            self.close_connection = True
+            self.send_json_error(411, "Content-Length required")
+            return False
+        length = content_length(self.headers.get("Content-Length", "0"))
+        if length is None:
+            self.close_connection = True
+            self.send_json_error(400, "Invalid Content-Length")
+            return False
+        if length > self.max_body_size:
+            self.close_connection = True
+            self.send_json_error(413, "Request body too large")
+            return False
+        self.body = self.rfile.read(length)
+        return True
+
+    def log_request(self, code="-", size="-"):
+        self.response_status = int(code) if code != "-" else None
+        super().log_request(code, size)
+
+    def log_message(self, format, *args):
+        writer = getattr(self.server, "log_writer", self.log_writer)
+        if writer is None:
+            return
+        message = (format % args).translate(CONTROL_CHARS)
+        writer(f"{self.address_string()} - - "
+               f"[{self.log_date_time_string()}] {message}\n")
+
+    def last_request(self):
+        return bool(self.max_requests and
+                    self.requests_served >= self.max_requests)
+
+    def end_headers(self):
+        if self.last_request():
+            self.send_header("Connection", "close")
+        super().end_headers()
+
+    def send_head(self, status_line, headers, body=b""):
+        """Write a response head built from pre-encoded parts, and body."""
+        parts = [status_line,
+                 b"Server: ", self.version_string().encode(),
+                 b"\r\nDate: ", http_date(), b"\r\n",
+                 headers]
+        if self.close_connection or self.last_request():
+            parts.append(b"Connection: close\r\n")
+            self.close_connection = True
+        parts.append(b"\r\n")
+        parts.append(body)
+        self.wfile.write(b"".join(parts))
+
+    def send_route(self, route):
+        encoding = None
+        if route.compressible:
+            encoding = negotiate_encoding(self.headers.get("Accept-Encoding"))
+        headers, body, etag, validators = route.variant(encoding)
+        if route.not_modified(etag, self.headers.get("If-None-Match"),
+                              self.headers.get("If-Modified-Since")):
+            self.log_request(304)
+            self.send_head(status_line(304), validators)
+        else:
+            self.log_request(route.status)
+            self.send_head(route.status_line, headers, body)
+
+    def send_static(self, name):
+        static = getattr(self.server, "static_files", None)
+        entry = static.get(name) if static else None
+        if entry is None:
+            self.send_route(NOT_FOUND)
+            return
+        validators = (f"ETag: {entry.etag}\r\n"
+                      f"Last-Modified: {entry.last_modified}\r\n")
+        if not_modified(entry.etag, entry.modified,
+                        self.headers.get("If-None-Match"),
+                        self.headers.get("If-Modified-Since")):
+            self.log_request(304)
+            self.send_head(status_line(304), validators.encode())
+            return
+        status, first, last = 200, 0, entry.size - 1
+        headers = validators + "Accept-Ranges: bytes\r\n"
+        range_header = self.headers.get("Range")
+        if_range = self.headers.get("If-Range")
+        if range_header and if_range in (None, entry.etag,
+                                         entry.last_modified):
+            byte_range = parse_range(range_header, entry.size)
+            if byte_range is False:
+                self.log_request(416)
+                self.send_head(status_line(416), (
+                    headers + f"Content-Range: bytes */{entry.size}\r\n"
+                    "Content-Length: 0\r\n").encode())
+                return
+            if byte_range:
+                status, (first, last) = 206, byte_range
+                headers += (f"Content-Range: bytes {first}-{last}"
+                            f"/{entry.size}\r\n")
+        headers += (f"Content-type: {entry.content_type}\r\n"
+                    f"Content-Length: {last - first + 1}\r\n")
+        self.log_request(status)
+        self.send_head(status_line(status), headers.encode())
+        self.send_file(FileSegment(entry, first, last - first + 1))
+
+    def send_file(self, segment):
+        if self.deferred is not None:
+            self.deferred.append(self.wfile.getvalue())
+            self.wfile.seek(0)
+            self.wfile.truncate()
+            self.deferred.append(segment)
+            return
+        sock = self.connection
+        while segment.count:
+            try:
+                segment.send(sock)
+            except BlockingIOError:
+                wait_writable(sock, sock.gettimeout())
+
+    def send_json_error(self, status, message):
+        self.send_route(Route.json({"error": message}, status))
+
+    def send_batch(self, paths):
+        """Answer several route paths in one JSON envelope."""
+        if not isinstance(paths, list) or \
+                not all(isinstance(path, str) for path in paths):
+            self.send_json_error(400, "Expected a list of paths")
+            return
+        if len(paths) > self.max_batch_paths:
+            self.send_json_error(400, f"At most {self.max_batch_paths} "
+                                      f"paths per batch")
+            return
+        entries = [(self.routes.lookup(path) or NOT_FOUND).batch_entry(path)
+                   for path in paths]
+        body = b'{"responses": [' + b", ".join(entries) + b"]}"
+        self.send_route(Route(200, "application/json", body,
+                              cacheable=False))
+
+    def do_POST(self):
+        if normalize_path(self.path) != BATCH_PATH:
+            self.send_error(501, f"Unsupported method ({self.command!r})")
+            return
+        self.metrics_path = BATCH_PATH
+        try:
+            data = json.loads(self.body)
+        except ValueError:
+            self.send_json_error(400, "Invalid JSON body")
+            return
+        if isinstance(data, dict):
+            data = data.get("paths")
+        self.send_batch(data)
+
+    def do_GET(self):
+        if self.path.startswith(STATIC_PREFIX):
+            self.metrics_path = STATIC_PREFIX
+            self.send_static(self.path[len(STATIC_PREFIX):].split("?", 1)[0])
+            return
+        path = normalize_path(self.path)
+        if path == METRICS_PATH:
+            self.metrics_path = path
+            self.send_route(Route(200, METRICS_TYPE, self.metrics.render(),
+                                  cacheable=False))
+            return
+        if path == BATCH_PATH:
+            self.metrics_path = path
+            query = urllib.parse.urlsplit(self.path).query
+            query = urllib.parse.parse_qs(query)
+            paths = query.get("path", [])
+            for value in query.get("paths", []):
+                paths.extend(path for path in value.split(",") if path)
+            self.send_batch(paths)
+            return
+        route = self.routes.lookup(path)
+        if route is None:
+            self.send_route(NOT_FOUND)
+        else:
+            self.metrics_path = path
+            self.send_route(route)
+
+
+class ThreadPoolHTTPServer(socketserver.TCPServer):
+    """
+    TCP server serving connections from a fixed pool of worker threads.
+
+    Accepted connections wait in a queue of at most queue_size entries;
+    when the queue is full the client gets a 503 and is disconnected.
+    Between requests, keep-alive connections are parked in a selector
+    watched by one thread and queued again once readable, so idle clients
+    never hold a worker; they are closed after idle_timeout seconds.
+    """
+    allow_reuse_address = True
+
+    def __init__(self, server_address, handler_class, workers=8,
+                 queue_size=64, idle_timeout=5.0, max_requests=100,
+                 sock=None, reuse_port=False):
+        self.pending = queue.Queue(queue_size)
+        self.idle_timeout = idle_timeout
+        self.max_requests = max_requests
+        self.reuse_port = reuse_port
+        super().__init__(server_address, handler_class,
+                         bind_and_activate=sock is None)
+        if sock is not None:
+            self.socket.close()
+            self.socket = sock
+            self.server_address = sock.getsockname()
+        # Requests served so far on parked connections, by socket
+        self.served = {}
+        self.parking = queue.SimpleQueue()
+        self.idle = selectors.DefaultSelector()
+        self.wakeup, self.wakeup_writer = socket.socketpair()
+        self.wakeup.setblocking(False)
+        self.idle.register(self.wakeup, selectors.EVENT_READ)
+        self.watcher = threading.Thread(target=self.watch_idle, daemon=True)
+        self.watcher.start()
+        self.threads = []
+        for _ in range(workers):
+            thread = threading.Thread(target=self.process_pending,
+                                      daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def process_request(self, request, client_address):
+        try:
+            self.pending.put_nowait((request, client_address))
+        except queue.Full:
+            try:
+                request.sendall(BUSY_RESPONSE)
+            except OSError:
+                pass
+            self.shutdown_request(request)
+
+    def server_bind(self):
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+    def process_pending(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            request, client_address = item
+            parked = False
+            try:
+                parked = self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                if not parked:
+                    self.served.pop(request, None)
+                    self.shutdown_request(request)
+
+    def finish_request(self, request, client_address):
+        """Serve a connection; return True if it was parked."""
+        handler = self.RequestHandlerClass(request, client_address, self)
+        if handler.parked:
+            self.park(request, client_address, handler.requests_served)
+        return handler.parked
+
+    def park(self, request, client_address, requests_served):
+        """Hand an idle keep-alive connection over to watch_idle."""
+        self.served[request] = requests_served
+        self.parking.put((request, client_address))
+        self.wakeup_writer.send(b"\0")
+
+    def watch_idle(self):
+        deadlines = {}
+        while True:
+            timeout = min(self.idle_timeout, 1.0) if self.idle_timeout \
+                else None
+            for key, _ in self.idle.select(timeout):
+                if key.fileobj is self.wakeup:
+                    try:
+                        self.wakeup.recv(4096)
+                    except (BlockingIOError, InterruptedError):
+                        pass
+                    while True:
+                        try:
+                            item = self.parking.get_nowait()
+                        except queue.Empty:
+                            break
+                        if item is None:
+                            for request in deadlines:
+                                self.idle.unregister(request)
+                                self.served.pop(request, None)
+                                self.shutdown_request(request)
+                            return
+                        request, client_address = item
+                        self.idle.register(request, selectors.EVENT_READ,
+                                           client_address)
+                        deadlines[request] = (time.monotonic() +
+                                              (self.idle_timeout or 0))
+                    continue
+                # The next request, or the peer closing, is a new job
+                self.idle.unregister(key.fileobj)
+                del deadlines[key.fileobj]
+                self.process_request(key.fileobj, key.data)
+            if self.idle_timeout:
+                now = time.monotonic()
+                for request, deadline in list(deadlines.items()):
+                    if deadline < now:
+                        self.idle.unregister(request)
+                        del deadlines[request]
+                        self.served.pop(request, None)
+                        self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.parking.put(None)
+        self.wakeup_writer.send(b"\0")
+        self.watcher.join()
+        for _ in self.threads:
+            self.pending.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.idle.close()
+        self.wakeup.close()
+        self.wakeup_writer.close()
+
+
+class Connection:
+    """Buffers of one client connection of the selector server."""
+
+    def __init__(self, sock, client_address):
+        self.sock = sock
+        self.client_address = client_address
+        self.inbuf = bytearray()
+        self.output = collections.deque()
+        self.events = selectors.EVENT_READ
+        self.closing = False
+        self.requests_served = 0
+        self.last_active = time.monotonic()
+
+
+class EventLoopServer:
+    """
+    Base of the servers running every connection on a single thread.
+
+    Complete requests are rendered by the usual handler class against
+    in-memory files, so responses are identical to the ones of the
+    threaded server.
+    """
+    max_head_size = 65536
+
+    def __init__(self, server_address, handler_class, idle_timeout=5.0,
+                 max_requests=100, sock=None, reuse_port=False):
+        self.RequestHandlerClass = handler_class
+        self.idle_timeout = idle_timeout
+        self.max_requests = max_requests
+        if sock is None:
+            sock = socket.create_server(server_address,
+                                        reuse_port=reuse_port)
+        self.socket = sock
+        self.socket.setblocking(False)
+        self.server_address = self.socket.getsockname()
+        self.stopped = threading.Event()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.server_close()
+
+    def body_length(self, head):
+        """
+        Return how many body bytes follow a raw request head.
+
+        Bodies with a Transfer-Encoding, an invalid length, or larger than
+        the handler accepts, are not waited for: the handler rejects the
+        request and closes the connection.
+        """
+        lengths = []
+        for line in bytes(head).split(b"\r\n")[1:]:
+            name, _, value = line.partition(b":")
+            name = name.strip().lower()
+            if name == b"transfer-encoding":
+                return 0
+            if name == b"content-length":
+                lengths.append(value)
+        if not lengths:
+            return 0
+        length = content_length(lengths[0].decode("latin-1"))
+        if length is None or length > self.RequestHandlerClass.max_body_size:
+            return 0
+        return length
+
+    def render(self, raw, conn):
+        """
+        Run the handler on one raw request of conn.
+
+        Returns the response as a list of bytes and FileSegment chunks,
+        files being sent later without being read in memory.
+        """
+        handler = self.RequestHandlerClass.__new__(self.RequestHandlerClass)
+        handler.server = self
+        handler.client_address = conn.client_address
+        handler.request = None
+        handler.rfile = io.BytesIO(raw)
+        handler.wfile = io.BytesIO()
+        handler.deferred = []
+        handler.close_connection = True
+        handler.max_requests = self.max_requests
+        handler.requests_served = conn.requests_served
+        handler.handle_one_request()
+        conn.requests_served = handler.requests_served
+        conn.closing = handler.close_connection
+        handler.deferred.append(handler.wfile.getvalue())
+        return handler.deferred
+
+    def handle_error(self, conn):
+        """Log the exception the handler raised on a request of conn."""
+        print("-" * 40, file=sys.stderr)
+        print("Exception occurred during processing of request from",
+              conn.client_address, file=sys.stderr)
+        traceback.print_exc()
+        print("-" * 40, file=sys.stderr)
+
+
+class SelectorHTTPServer(EventLoopServer):
+    """
+    Single-threaded HTTP server multiplexing connections with selectors.
+
+    Complete requests are read without blocking and rendered in memory.
+    Pipelined requests are answered in order and connections idle for
+    idle_timeout seconds are closed.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.connections = {}
+        self.next_sweep = 0.0
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.socket, selectors.EVENT_READ)
+        self.running = False
+
+    def serve_forever(self, poll_interval=0.5):
+        self.running = True
+        self.stopped.clear()
+        try:
+            while self.running:
+                for key, events in self.selector.select(poll_interval):
+                    if key.data is None:
+                        self.accept()
+                    elif events & selectors.EVENT_READ:
+                        self.read(key.data)
+                    elif events & selectors.EVENT_WRITE:
+                        self.write(key.data)
+                self.close_idle()
+        finally:
+            self.stopped.set()
+
+    def shutdown(self):
+        self.running = False
+        self.stopped.wait()
+
+    def server_close(self):
+        for conn in list(self.connections.values()):
+            self.close(conn)
+        self.selector.close()
+        self.socket.close()
+
+    def accept(self):
+        try:
+            sock, client_address = self.socket.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        sock.setblocking(False)
+        conn = Connection(sock, client_address)
+        self.connections[sock] = conn
+        self.selector.register(sock, selectors.EVENT_READ, conn)
+
+    def close_idle(self):
+        now = time.monotonic()
+        if not self.idle_timeout or now < self.next_sweep:
+            return
+        self.next_sweep = now + min(self.idle_timeout, 1.0)
+        deadline = now - self.idle_timeout
+        for conn in list(self.connections.values()):
+            if conn.last_active < deadline:
+                self.close(conn)
+
+    def read(self, conn):
+        try:
+            data = conn.sock.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self.close(conn)
+            return
+        conn.last_active = time.monotonic()
+        conn.inbuf += data
+        while not conn.closing:
+            end = conn.inbuf.find(b"\r\n\r\n")
+            if end < 0:
+                if len(conn.inbuf) > self.max_head_size:
+                    self.close(conn)
+                    return
+                break
+            size = end + 4 + self.body_length(conn.inbuf[:end])
+            if len(conn.inbuf) < size:
+                break
+            raw = bytes(conn.inbuf[:size])
+            del conn.inbuf[:size]
+            # A failing request only costs its own connection
+            try:
+                chunks = self.render(raw, conn)
+            except Exception:
+                self.handle_error(conn)
+                self.close(conn)
+                return
+            self.queue(conn, chunks)
+        self.write(conn)
+
+    def queue(self, conn, chunks):
+        """Append response chunks, merging consecutive bytes together."""
+        for chunk in chunks:
+            if isinstance(chunk, FileSegment):
+                conn.output.append(chunk)
+            elif chunk:
+                if conn.output and isinstance(conn.output[-1], bytearray):
+                    conn.output[-1] += chunk
+                else:
+                    conn.output.append(bytearray(chunk))
+
+    def write(self, conn):
+        output = conn.output
+        try:
+            while output:
+                item = output[0]
+                if isinstance(item, FileSegment):
+                    item.send(conn.sock)
+                    if item.count:
+                        break
+                else:
+                    del item[:conn.sock.send(item)]
+                    if item:
+                        break
+                output.popleft()
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError:
+            self.close(conn)
+            return
+        conn.last_active = time.monotonic()
+        if output:
+            self.watch(conn, selectors.EVENT_WRITE)
+        elif conn.closing:
+            self.close(conn)
+        else:
+            self.watch(conn, selectors.EVENT_READ)
+
+    def watch(self, conn, events):
+        if conn.events != events:
+            self.selector.modify(conn.sock, events, conn)
+            conn.events = events
+
+    def close(self, conn):
+        self.connections.pop(conn.sock, None)
+        try:
+            self.selector.unregister(conn.sock)
+        except (KeyError, ValueError):
+            pass
+        conn.sock.close()
+
+
+class AsyncioHTTPServer(EventLoopServer):
+    """
+    HTTP server running every connection as a task of an asyncio loop.
+
+    Mostly idle keep-alive connections only cost a suspended coroutine.
+    Requests are parsed from the stream as they come, pipelined ones in
+    order, and rendered in memory. Writes wait for the transport to drain
+    once its buffer is not empty, so slow readers apply backpressure; a
+    connection is dropped after idle_timeout seconds without a request
+    or write_timeout seconds without its peer reading.
+    """
+
+    def __init__(self, *args, write_timeout=30.0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.write_timeout = write_timeout
+        self.loop = None
+        self.stopping = None
+        self.ready = threading.Event()
+        self.writers = {}
+
+    def serve_forever(self, poll_interval=None):
+        self.stopped.clear()
+        try:
+            asyncio.run(self.serve())
+        finally:
+            self.stopped.set()
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+        server = await asyncio.start_server(self.handle_connection,
+                                            sock=self.socket,
+                                            limit=self.max_head_size)
+        self.ready.set()
+        async with server:
+            await self.stopping.wait()
+            server.close()
+            for writer in self.writers:
+                writer.close()
+            await asyncio.gather(*self.writers.values(),
+                                 return_exceptions=True)
+
+    def shutdown(self):
+        self.ready.wait()
+        self.loop.call_soon_threadsafe(self.stopping.set)
+        self.stopped.wait()
+
+    def server_close(self):
+        self.socket.close()
+
+    async def handle_connection(self, reader, writer):
+        conn = Connection(writer.get_extra_info("socket"),
+                          writer.get_extra_info("peername"))
+        self.writers[writer] = asyncio.current_task()
+        try:
+            while not conn.closing:
+                try:
+                    raw = await asyncio.wait_for(
+                        reader.readuntil(b"\r\n\r\n"),
+                        self.idle_timeout or None)
+                    length = self.body_length(raw)
+                    if length:
+                        raw += await asyncio.wait_for(
+                            reader.readexactly(length),
+                            self.idle_timeout or None)
+                except (asyncio.IncompleteReadError,
+                        asyncio.LimitOverrunError):
+                    break
+                try:
+                    chunks = self.render(raw, conn)
+                except Exception:
+                    self.handle_error(conn)
+                    break
+                for chunk in chunks:
+                    if isinstance(chunk, FileSegment):
+                        await self.send_file(writer, chunk)
+                    elif chunk:
+                        writer.write(chunk)
+                if writer.transport.get_write_buffer_size():
+                    await asyncio.wait_for(writer.drain(),
+                                           self.write_timeout)
+        except (asyncio.TimeoutError, OSError):
+            pass
+        finally:
+            del self.writers[writer]
+            writer.close()
+
+    async def send_file(self, writer, segment):
+        if not segment.count:
+            return
+        await asyncio.wait_for(writer.drain(), self.write_timeout)
+        if FileSegment.use_sendfile:
+            try:
+                await self.loop.sendfile(writer.transport, segment.file.file,
+                                         segment.offset, segment.count,
+                                         fallback=False)
+                return
+            except asyncio.SendfileNotAvailableError:
+                pass
+        while segment.count:
+            chunk = os.pread(segment.file.fd, min(segment.count, SEND_CHUNK),
+                             segment.offset)
+            if not chunk:
+                raise OSError(errno.EIO, "static file shrank while sending")
+            writer.write(chunk)
+            segment.offset += len(chunk)
+            segment.count -= len(chunk)
+            await asyncio.wait_for(writer.drain(), self.write_timeout)
+
+
+def make_server(port=PORT, mode="threaded", workers=8, queue_size=64,
+                idle_timeout=5.0, max_requests=100, sock=None,
+                reuse_port=False, static_dir=None, log="sync"):
+    """
+    Build, without starting it, a server in the requested mode.
+
+    The server listens on sock when given, otherwise it binds its own
+    socket to port, with SO_REUSEPORT set when reuse_port is true.
+    Files of static_dir, if given, are served under /static/. log is one
+    of LOG_MODES and selects how the access log is written.
+    """
+    options = {"idle_timeout": idle_timeout, "max_requests": max_requests,
+               "sock": sock, "reuse_port": reuse_port}
+    if mode == "threaded":
+        httpd = ThreadPoolHTTPServer(("", port), RequestHandler,
+                                     workers=workers, queue_size=queue_size,
+                                     **options)
+    elif mode == "selector":
+        httpd = SelectorHTTPServer(("", port), RequestHandler, **options)
+    elif mode == "asyncio":
+        httpd = AsyncioHTTPServer(("", port), RequestHandler, **options)
+    else:
+        raise ValueError(f"Unknown mode {mode!r}, expected one of {MODES}")
+    httpd.static_files = StaticFiles(static_dir) if static_dir else None
+    httpd.log_writer = make_log_writer(log)
+    return httpd
+
+
+def run_server(port=PORT, **options):
+    """Serve the API from this process until interrupted."""
+    with make_server(port, **options) as httpd:
+        print(f"Serving on port {port}")
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+def serve_worker(port, sock, reuse_port, options):
+    """
+    Body of a pre-forked worker process.
+
+    Returns on SIGTERM or when the supervisor process goes away.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    supervisor = os.getppid()
+    with make_server(port, sock=sock, reuse_port=reuse_port,
+                     **options) as httpd:
+        def stop(signum=None, frame=None):
+            threading.Thread(target=httpd.shutdown, daemon=True).start()
+
+        def watch_supervisor():
+            while os.getppid() == supervisor:
+                time.sleep(1)
+            stop()
+
+        signal.signal(signal.SIGTERM, stop)
+        threading.Thread(target=watch_supervisor, daemon=True).start()
+        httpd.serve_forever()
+
+
+def run_prefork(processes, port=PORT, **options):
+    """
+    Serve the API from several forked worker processes.
+
+    Each worker binds its own SO_REUSEPORT socket so the kernel spreads
+    connections across them; without SO_REUSEPORT (or on an ephemeral
+    port) the workers share a socket inherited from the supervisor.
+    Workers that die are restarted. SIGTERM or SIGINT stops the workers
+    gracefully: they stop accepting, finish their current connections and
+    exit, then the supervisor returns.
+    """
+    reuse_port = hasattr(socket, "SO_REUSEPORT") and port != 0
+    sock = None
+    if not reuse_port:
+        sock = socket.create_server(("", port))
+        port = sock.getsockname()[1]
+    children = {}
+    stopping = False
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            # Until the worker installs its own handler, a SIGTERM must
+            # not run the supervisor's stop() inherited with the fork
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            status = 0
+            try:
+                serve_worker(port, sock, reuse_port, options)
+            except BaseException:
+                traceback.print_exc()
+                status = 1
+            finally:
+                os._exit(status)
+        children[pid] = time.monotonic()
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for _ in range(processes):
+        spawn()
+    print(f"Serving on port {port} with {processes} processes")
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        started = children.pop(pid, None)
+        if stopping or started is None:
+            continue
+        code = os.waitstatus_to_exitcode(status)
+        print(f"Worker {pid} exited with code {code}, restarting",
+              file=sys.stderr)
+        if time.monotonic() - started < 1:
+            time.sleep(1)
+        spawn()
+    if sock is not None:
+        sock.close()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Simple http.server API")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--mode", choices=MODES, default="threaded")
+    parser.add_argument("--workers", type=int, default=8,
+                        help="threads serving requests in threaded mode; "
+                             "idle keep-alive connections hold none")
+    parser.add_argument("--queue-size", type=int, default=64)
+    parser.add_argument("--idle-timeout", type=float, default=5.0,
+                        help="seconds before an idle connection is closed")
+    parser.add_argument("--max-requests", type=int, default=100,
+                        help="requests served per connection, 0 for no cap")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="pre-forked worker processes, 1 to not fork")
+    parser.add_argument("--static-dir", default=STATIC_DIR,
+                        help="directory served under /static/")
+    parser.add_argument("--log", choices=LOG_MODES, default="sync",
+                        help="write the access log inline, from a "
+                             "background thread, or not at all")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    options = {"mode": args.mode, "workers": args.workers,
+               "queue_size": args.queue_size,
+               "idle_timeout": args.idle_timeout,
+               "max_requests": args.max_requests,
+               "static_dir": args.static_dir, "log": args.log}
+    if args.processes > 1:
+        run_prefork(args.processes, args.port, **options)
+    else:
+        run_server(args.port, **options)
@@ -1,9 +1,539 @@
-from flask import Flask, jsonify, request
+import argparse
+import atexit
+import bisect
+import codecs
+import collections
+import heapq
+import itertools
+import json
+import logging
+import math
+import operator
+import re
+import secrets
+import sqlite3
+import sys
+import threading
+
+from flask import Flask, Response, jsonify, request
 
 app = Flask(__name__)
+log = logging.getLogger(__name__)
+
+MAX_PAGE_SIZE = 1000
+STREAM_CHUNK = 1000
+INGEST_BATCH = 10000
+MAX_REPORTED_ERRORS = 100
+MAX_RECORD_SIZE = 1 << 20
+SEPARATORS = re.compile(r"[\s,]*")
+FLUSH_INTERVAL = 0.1
+MAX_PENDING = 10000
+CHANGES_SIZE = 10000
+MAX_POLL_TIMEOUT = 60.0
+HEARTBEAT = 15.0
+MAX_BATCH_SIZE = 1000
+
+
+def make_user(data):
+    return {"username": data.get("username"), "name": data.get("name"),
+            "age": data.get("age"), "city": data.get("city")}
+
+
+class SQLiteBackend:
+    """
+    Write-behind persistence of users in a SQLite database in WAL mode.
+
+    Writes are queued in memory, coalesced by username, and committed by a
+    background thread in one transaction every flush_interval seconds, or
+    as soon as max_pending users are queued. A crash loses at most the
+    last flush_interval seconds and max_pending users: writers block while
+    the queue is full.
+    """
+
+    def __init__(self, path, flush_interval=FLUSH_INTERVAL,
+                 max_pending=MAX_PENDING):
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.pending = {}
+        self.closed = False
+        self.ready = threading.Condition()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS users "
+                        "(username TEXT PRIMARY KEY, data TEXT NOT NULL) "
+                        "WITHOUT ROWID")
+        self.db.commit()
+        self.writer = threading.Thread(target=self.run, daemon=True)
+        self.writer.start()
+
+    def load(self):
+        """Yield every stored user, as a dict."""
+        cursor = self.db.execute("SELECT data FROM users")
+        while True:
+            rows = cursor.fetchmany(INGEST_BATCH)
+            if not rows:
+                return
+            for (data,) in rows:
+                yield json.loads(data)
+
+    def queue(self, batch):
+        """Queue User records for the next flush, without blocking."""
+        with self.ready:
+            for user in batch:
+                self.pending[user.username] = user
+            if len(self.pending) >= self.max_pending:
+                self.ready.notify_all()
+
+    def wait_for_room(self):
+        """Block while max_pending users are queued."""
+        with self.ready:
+            self.ready.wait_for(lambda: self.closed or
+                                len(self.pending) < self.max_pending)
+
+    def run(self):
+        while True:
+            with self.ready:
+                self.ready.wait_for(lambda: self.closed or
+                                    len(self.pending) >= self.max_pending,
+                                    self.flush_interval)
+                batch, self.pending = self.pending, {}
+                closed = self.closed
+                self.ready.notify_all()
+            if batch:
+                try:
+                    self.flush(batch.values())
+                except sqlite3.Error:
+                    log.exception("Lost %d users", len(batch))
+            if closed:
+                return
+
+    def flush(self, batch):
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO users VALUES (?, ?)",
+                ((user.username, json.dumps(user.as_dict()))
+                 for user in batch))
+
+    def close(self):
+        """Flush the queued writes and close the database."""
+        with self.ready:
+            self.closed = True
+            self.ready.notify_all()
+        self.writer.join()
+        self.db.close()
+
+
+class ChangeFeed:
+    """
+    The last `size` changes to the users, numbered from 1, in a ring
+    buffer that readers wait on for changes past a sequence number.
+    """
+
+    def __init__(self, size=CHANGES_SIZE):
+        self.events = collections.deque(maxlen=size)
+        self.seq = 0
+        self.changed = threading.Condition()
+
+    def publish(self, changes):
+        """Append (kind, User) changes and wake up the waiting readers."""
+        with self.changed:
+            for kind, user in changes:
+                self.seq += 1
+                self.events.append((self.seq, kind, user))
+            self.changed.notify_all()
+
+    def wait(self, since, timeout):
+        """
+        Wait up to timeout seconds for changes past since, and return
+        (changes, last sequence number, reset). reset is true when since
+        is no longer in the buffer: the reader missed changes and should
+        reload every user.
+        """
+        with self.changed:
+            self.changed.wait_for(lambda: self.seq != since, timeout)
+            first = self.events[0][0] if self.events else self.seq + 1
+            if since > self.seq or since < first - 1:
+                return [], self.seq, True
+            start = len(self.events) - (self.seq - since)
+            changes = list(itertools.islice(self.events, start, None))
+            return changes, self.seq, False
+
+
+def insert_sorted(items, new):
+    """Add new items to a sorted list, returning the updated list."""
+    if len(new) == 1:
+        bisect.insort(items, next(iter(new)))
+    elif new:
+        # Merged apart and swapped in at once, so readers never see a
+        # partially sorted list
+        items = items + sorted(new)
+        items.sort()
+    return items
+
+
+class User:
+    """
+    A stored user: slots instead of a per-user dict, and an interned city
+    name, so all the users of a city share a single string.
+    """
+    __slots__ = ("username", "name", "age", "city")
+
+    def __init__(self, username, name=None, age=None, city=None):
+        self.username = username
+        self.name = name
+        self.age = age
+        self.city = sys.intern(city) if type(city) is str else city
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["username"], data.get("name"), data.get("age"),
+                   data.get("city"))
+
+    def as_dict(self):
+        return {"username": self.username, "name": self.name,
+                "age": self.age, "city": self.city}
+
+    def indexed_age(self):
+        """Return the age if it can be indexed, else None."""
+        age = self.age
+        if isinstance(age, (int, float)) and not isinstance(age, bool):
+            return age
+        return None
+
+    def in_range(self, age_min, age_max):
+        age = self.indexed_age()
+        return age is not None and (age_min is None or age >= age_min) and \
+            (age_max is None or age <= age_max)
+
+
+class Shard:
+    """
+    One stripe of a UserStore: its own lock, users and sorted names,
+    secondary indexes of usernames by city and by age, with the ages kept
+    sorted, and the cached JSON body of each user.
+    """
+    __slots__ = ("lock", "users", "names", "cities", "ages", "age_keys",
+                 "bodies")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.users = {}
+        self.names = []
+        self.cities = {}
+        self.ages = {}
+        self.age_keys = []
+        self.bodies = {}
+
+    def index(self, user):
+        if type(user.city) is str:
+            self.cities.setdefault(user.city, set()).add(user.username)
+        age = user.indexed_age()
+        if age is not None:
+            names = self.ages.get(age)
+            if names is None:
+                names = self.ages[age] = set()
+                bisect.insort(self.age_keys, age)
+            names.add(user.username)
+
+    def unindex(self, user):
+        if type(user.city) is str:
+            names = self.cities[user.city]
+            names.discard(user.username)
+            if not names:
+                del self.cities[user.city]
+        age = user.indexed_age()
+        if age is not None:
+            names = self.ages[age]
+            names.discard(user.username)
+            if not names:
+                del self.ages[age]
+                del self.age_keys[bisect.bisect_left(self.age_keys, age)]
+
+
+class UserStore:
+    """
+    Users striped over shards by username hash.
+
+    Writers lock only the shards they touch, so writes to different shards
+    never contend. Lookups take no lock: a single dict lookup or list slice
+    is atomic, and each shard's name list is replaced or grown in one step.
+    Index queries hold each shard lock only while collecting its matches.
+    """
+
+    def __init__(self, shards=16, backend=None):
+        self.shards = [Shard() for _ in range(shards)]
+        self.backend = backend
+        # Bumped after every write, each value used once, so a cached
+        # rendering of all users is valid while the version is unchanged
+        self.versions = itertools.count(1)
+        self.version = 0
+        self.token = secrets.token_hex(4)
+        self.names_body = (None, None)
+        self.changes = ChangeFeed()
+        if backend is not None:
+            # Warm up from the backend in a single batch, skipping any
+            # user stored before usernames had to be strings
+            self.put_many((user for user in backend.load()
+                           if type(user.get("username")) is str),
+                          persist=False)
+
+    def shard(self, username):
+        return self.shards[hash(username) % len(self.shards)]
 
-# Global users dictionary to store user data
-users = {}
+    def get(self, username):
+        user = self.shard(username).users.get(username)
+        return None if user is None else user.as_dict()
+
+    def __contains__(self, username):
+        return username in self.shard(username).users
+
+    def __len__(self):
+        return sum(len(shard.users) for shard in self.shards)
+
+    def put(self, user):
+        self.put_many([user])
+
+    def put_many(self, batch, persist=True):
+        """
+        Store a batch of users, locking each shard it touches once.
+
+        Raises TypeError, before any shard changes, if a username is not
+        a string: the sorted name lists could not hold it.
+        """
+        by_shard = {}
+        for data in batch:
+            # The last write of a username in the batch wins
+            user = User.from_dict(data)
+            if type(user.username) is not str:
+                raise TypeError(f"username must be a string, "
+                                f"not {type(user.username).__name__}")
+            shard = self.shard(user.username)
+            by_shard.setdefault(shard, {})[user.username] = user
+        for shard, shard_users in by_shard.items():
+            with shard.lock:
+                new_names = []
+                changes = []
+                for username, user in shard_users.items():
+                    old = shard.users.get(username)
+                    if old is None:
+                        new_names.append(username)
+                        changes.append(("add", user))
+                    else:
+                        shard.unindex(old)
+                        changes.append(("update", user))
+                    shard.users[username] = user
+                    shard.bodies.pop(username, None)
+                    shard.index(user)
+                shard.names = insert_sorted(shard.names, new_names)
+                # Queued under the shard lock, so the backend and the
+                # change feed see writes to a username in the same order
+                # as the shard; a warm-up is not a change
+                if persist and self.backend is not None:
+                    self.backend.queue(shard_users.values())
+                if persist:
+                    self.changes.publish(changes)
+            # A full queue blocks this writer only, not the shard's readers
+            if persist and self.backend is not None:
+                self.backend.wait_for_room()
+        self.version = next(self.versions)
+
+    def body(self, username, render):
+        """
+        Return the user's JSON body, rendered once with render(user) and
+        cached until the user is overwritten, or None if unknown.
+        """
+        shard = self.shard(username)
+        body = shard.bodies.get(username)
+        if body is None:
+            user = shard.users.get(username)
+            if user is None:
+                return None
+            body = render(user.as_dict())
+            with shard.lock:
+                # Not cached if the user changed while rendering
+                if shard.users.get(username) is user:
+                    shard.bodies[username] = body
+        return body
+
+    def names(self, render):
+        """
+        Return the ETag and JSON body of all usernames, rendered once with
+        render(names) and cached until the next write.
+        """
+        version = self.version
+        cached_version, body = self.names_body
+        if cached_version != version:
+            body = render(list(self.iter_names()))
+            self.names_body = (version, body)
+        return f"{self.token}-{version}", body
+
+    def find(self, city=None, age_min=None, age_max=None):
+        """
+        Return the users matching every given filter, sorted by username.
+
+        Each shard answers from whichever of its city or age index gives
+        fewer candidates, so a query costs O(k) in the result size.
+        """
+        found = []
+        for shard in self.shards:
+            with shard.lock:
+                if age_min is None and age_max is None:
+                    candidates = list(shard.cities.get(city, ()))
+                else:
+                    start = 0 if age_min is None else \
+                        bisect.bisect_left(shard.age_keys, age_min)
+                    end = len(shard.age_keys) if age_max is None else \
+                        bisect.bisect_right(shard.age_keys, age_max)
+                    by_age = [shard.ages[age]
+                              for age in shard.age_keys[start:end]]
+                    by_city = shard.cities.get(city, ())
+                    if city is not None and \
+                            len(by_city) < sum(map(len, by_age)):
+                        candidates = [name for name in by_city
+                                      if shard.users[name].in_range(
+                                          age_min, age_max)]
+                    else:
+                        candidates = [name for names in by_age
+                                      for name in names
+                                      if city is None or
+                                      shard.users[name].city == city]
+                found.extend(shard.users[name] for name in candidates)
+        found.sort(key=operator.attrgetter("username"))
+        return [user.as_dict() for user in found]
+
+    def close(self):
+        if self.backend is not None:
+            self.backend.close()
+
+    def iter_names(self, after=None, limit=None):
+        """
+        Yield usernames in order, starting after the given one.
+
+        Each shard's names are read in chunks re-located with bisect and
+        merged, so users added while iterating neither break nor repeat
+        the iteration.
+        """
+        while limit is None or limit > 0:
+            size = STREAM_CHUNK if limit is None else min(limit, STREAM_CHUNK)
+            runs = []
+            for shard in self.shards:
+                names = shard.names
+                start = bisect.bisect_right(names, after) if after else 0
+                runs.append(names[start:start + size])
+            chunk = list(itertools.islice(heapq.merge(*runs), size))
+            if not chunk:
+                return
+            yield from chunk
+            after = chunk[-1]
+            if limit is not None:
+                limit -= len(chunk)
+
+
+# Global user store, shared by the request threads
+users = UserStore()
+
+
+def iter_ndjson(stream, chunk_size=65536):
+    """
+    Yield (line number, record or error message) of an NDJSON body.
+
+    A line longer than MAX_RECORD_SIZE bytes is rejected and ends the
+    body, so a line is never buffered past that size.
+    """
+    number = 0
+    rest = b""
+    while True:
+        chunk = stream.read(chunk_size)
+        lines = (rest + chunk).split(b"\n")
+        rest = lines.pop() if chunk else b""
+        for line in lines:
+            number += 1
+            if not line.strip():
+                continue
+            if len(line) > MAX_RECORD_SIZE:
+                yield number, f"Record larger than {MAX_RECORD_SIZE} bytes"
+                return
+            try:
+                yield number, json.loads(line)
+            except ValueError as e:
+                yield number, f"Invalid JSON: {e}"
+        if len(rest) > MAX_RECORD_SIZE:
+            yield number + 1, f"Record larger than {MAX_RECORD_SIZE} bytes"
+            return
+        if not chunk:
+            return
+
+
+def iter_json_array(stream, chunk_size=65536):
+    """
+    Yield (index, record or error message) of a JSON array body.
+
+    The body is decoded incrementally, one record at a time, so the whole
+    array is never held in memory. A record longer than MAX_RECORD_SIZE
+    characters is rejected and ends the array, which also bounds how
+    often an incomplete record is parsed again.
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    position = 0
+    started = eof = False
+    index = 0
+    while True:
+        position = SEPARATORS.match(buffer, position).end()
+        if not started and position < len(buffer):
+            if buffer[position] != "[":
+                yield 0, "Body must be a JSON array"
+                return
+            started = True
+            position = SEPARATORS.match(buffer, position + 1).end()
+        if started and buffer.startswith("]", position):
+            return
+        if started and position < len(buffer):
+            try:
+                record, end = decoder.raw_decode(buffer, position)
+                complete = True
+            except ValueError as e:
+                if eof:
+                    yield index, f"Invalid JSON: {e}"
+                    return
+                end, complete = len(buffer), False
+            if end - position > MAX_RECORD_SIZE:
+                yield index, (f"Record larger than {MAX_RECORD_SIZE} "
+                              f"characters")
+                return
+            if complete:
+                yield index, record
+                index += 1
+                position = end
+                continue
+        if eof:
+            if not started:
+                yield 0, "Body must be a JSON array"
+            elif position < len(buffer):
+                yield index, "Unterminated JSON array"
+            return
+        chunk = stream.read(chunk_size)
+        eof = not chunk
+        buffer = buffer[position:] + text_decoder.decode(chunk, final=eof)
+        position = 0
+
+
+def render_json(value):
+    return jsonify(value).get_data()
+
+
+def stream_json_array(names):
+    yield "["
+    for index, name in enumerate(names):
+        yield ("," if index else "") + json.dumps(name)
+    yield "]\n"
+
+
+def stream_ndjson(names):
+    for name in names:
+        yield json.dumps(name) + "\n"
 
 @app.route("/")
 def home():
@@ -11,27 +541,183 @@ def home():
 
 @app.route("/data")
 def data():
-    user = list(users)
-    return jsonify(user)
+    # Without parameters, return every username as before
+    after = request.args.get("after")
+    limit = request.args.get("limit")
+    stream = request.args.get("stream")
+    # or 304 if the client already has this version of the list
+    if after is None and limit is None and stream is None:
+        etag, body = users.names(render_json)
+        response = Response(body, mimetype="application/json")
+        response.set_etag(etag)
+        return response.make_conditional(request)
+
+    # ?stream=json or ?stream=ndjson: stream usernames from a generator,
+    # in constant memory whatever the number of users
+    if stream is not None:
+        if limit is not None and not limit.isdigit():
+            return jsonify({"error": "limit must be a positive integer"}), 400
+        names = users.iter_names(after, int(limit) if limit else None)
+        if stream == "ndjson":
+            return Response(stream_ndjson(names),
+                            mimetype="application/x-ndjson")
+        if stream == "json":
+            return Response(stream_json_array(names),
+                            mimetype="application/json")
+        return jsonify({"error": "stream must be json or ndjson"}), 400
+
+    # ?limit=N&after=cursor: one page of usernames and the next cursor
+    limit = limit or str(MAX_PAGE_SIZE)
+    if not limit.isdigit() or not 0 < int(limit) <= MAX_PAGE_SIZE:
+        return jsonify({"error": f"limit must be between 1 and "
+                                 f"{MAX_PAGE_SIZE}"}), 400
+    page = list(users.iter_names(after, int(limit) + 1))
+    next_cursor = page[-2] if len(page) > int(limit) else None
+    return jsonify({"users": page[:int(limit)], "next": next_cursor})
 
 @app.post("/add_user")
 def add():
     data = request.json
-    user = {"username": data.get("username"), "name": data.get("name"), "age": data.get("age"), "city": data.get("city")}
+    user = make_user(data)
 
     if user["username"] is None:
         return {"error":"Username is required"}, 400
-    users[data.get("username")] = user
+    if not isinstance(user["username"], str):
+        return {"error": "Username must be a string"}, 400
+    users.put(user)
     return jsonify({'message': 'User added', 'user': user}), 201
 
+@app.post("/add_users")
+def add_many():
+    # Bulk import from an NDJSON (application/x-ndjson) or JSON array body,
+    # read as a stream and stored in batches of INGEST_BATCH users
+    if request.mimetype == "application/x-ndjson":
+        records = iter_ndjson(request.stream)
+    else:
+        records = iter_json_array(request.stream)
+    accepted = rejected = 0
+    errors = []
+    batch = []
+    for position, record in records:
+        if isinstance(record, str):
+            error = record
+        elif not isinstance(record, dict):
+            error = "Record must be a JSON object"
+        elif record.get("username") is None:
+            error = "Username is required"
+        elif not isinstance(record["username"], str):
+            error = "Username must be a string"
+        else:
+            batch.append(make_user(record))
+            if len(batch) >= INGEST_BATCH:
+                users.put_many(batch)
+                accepted += len(batch)
+                batch = []
+            continue
+        rejected += 1
+        if len(errors) < MAX_REPORTED_ERRORS:
+            errors.append({"record": position, "error": error})
+    if batch:
+        users.put_many(batch)
+        accepted += len(batch)
+    return jsonify({"accepted": accepted, "rejected": rejected,
+                    "errors": errors})
+
+def change_events(changes):
+    return [{"seq": seq, "type": kind, "user": user.as_dict()}
+            for seq, kind, user in changes]
+
+
+def stream_changes(since):
+    # Server-Sent Events: one event per change, its sequence number as id,
+    # and a comment as heartbeat so dead clients are noticed. The first
+    # heartbeat is sent at once, so the client gets the headers
+    yield ": heartbeat\n\n"
+    while True:
+        changes, since, reset = users.changes.wait(since, HEARTBEAT)
+        if reset:
+            yield f"id: {since}\nevent: reset\ndata: {{}}\n\n"
+        elif not changes:
+            yield ": heartbeat\n\n"
+        for event in change_events(changes):
+            yield (f"id: {event['seq']}\nevent: {event['type']}\n"
+                   f"data: {json.dumps(event['user'])}\n\n")
+
+@app.route("/changes")
+def change_feed():
+    # Users added or updated after ?since= (or the Last-Event-ID header),
+    # streamed as Server-Sent Events or long-polled as JSON
+    since = request.args.get("since", request.headers.get("Last-Event-ID"))
+    timeout = request.args.get("timeout", "30")
+    try:
+        since = users.changes.seq if since is None else int(since)
+        timeout = float(timeout)
+        # nan would slip past min() and make the wait endless
+        if not math.isfinite(timeout):
+            raise ValueError(f"timeout must be finite, not {timeout}")
+        timeout = min(timeout, MAX_POLL_TIMEOUT)
+    except ValueError:
+        return jsonify({"error": "since and timeout must be numbers"}), 400
+    if request.accept_mimetypes.best == "text/event-stream":
+        return Response(stream_changes(since), mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache"})
+    changes, last, reset = users.changes.wait(since, max(timeout, 0.0))
+    return jsonify({"changes": change_events(changes), "next": last,
+                    "reset": reset})
+
+@app.route("/users")
+def find_users():
+    # Users matching ?city=, ?age_min= and ?age_max=, from the indexes
+    city = request.args.get("city")
+    bounds = {}
+    for name in ("age_min", "age_max"):
+        value = request.args.get(name)
+        if value is not None:
+            try:
+                bounds[name] = int(value)
+            except ValueError:
+                return jsonify({"error": f"{name} must be an integer"}), 400
+    if city is None and not bounds:
+        return jsonify({"error": "city, age_min or age_max is required"}), 400
+    return jsonify(users.find(city, **bounds))
+
+@app.route("/users/batch", methods=["GET", "POST"])
+def get_users():
+    # Several users at once: ?username=a&username=b, or a POST body of
+    # {"usernames": [...]} or a plain list. Found users keep the request
+    # order and are assembled from their cached bodies
+    if request.method == "POST":
+        names = request.get_json(silent=True)
+        if isinstance(names, dict):
+            names = names.get("usernames")
+    else:
+        names = request.args.getlist("username")
+    if not isinstance(names, list) or \
+            not all(isinstance(name, str) for name in names):
+        return jsonify({"error": "usernames must be a list of strings"}), 400
+    names = list(dict.fromkeys(names))
+    if len(names) > MAX_BATCH_SIZE:
+        return jsonify({"error": f"At most {MAX_BATCH_SIZE} usernames "
+                                 f"per batch"}), 400
+    found = []
+    missing = []
+    for name in names:
+        body = users.body(name, render_json)
+        if body is None:
+            missing.append(name)
+        else:
+            found.append(body.rstrip(b"\n"))
+    body = b'{"missing":%s,"users":[%s]}\n' % (
+        render_json(missing).rstrip(b"\n"), b",".join(found))
+    return Response(body, mimetype="application/json")
+
 @app.route("/users/<username>")
 def get_user(username):
     # Dynamic route to get user details by username
-    if username in users:
-        # Create a response that includes the username and all user details
-        response = {"username": username}
-        response.update(users[username])  # Add all user details to the response
-        return jsonify(response)
+    # The user's details, username included, served from the cached body
+    body = users.body(username, render_json)
+    if body is not None:
+        return Response(body, mimetype="application/json")
     else:
         return jsonify({"error": "User not found"}), 404
 
@@ -40,5 +726,20 @@ def status():
     # Simple status endpoint
     return "OK"
 
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Run the Flask users API.")
+    parser.add_argument("--db", help="persist users to this SQLite file")
+    parser.add_argument("--flush-interval", type=float,
+                        default=FLUSH_INTERVAL,
+                        help="seconds between batched database writes")
+    parser.add_argument("--max-pending", type=int, default=MAX_PENDING,
+                        help="queued users that force a database write")
+    return parser.parse_args(argv)
+
 if __name__ == "__main__":
+    args = parse_args()
+    if args.db:
+        users = UserStore(backend=SQLiteBackend(
+            args.db, args.flush_interval, args.max_pending))
+        atexit.register(users.close)
     app.run(debug=False)
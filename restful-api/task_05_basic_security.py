@@ -1,12 +1,366 @@
-from flask import Flask, jsonify, request
+import collections
+import hashlib
+import hmac
+import math
+import os
+import secrets
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import Flask, Response, abort, jsonify, request
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_httpauth import HTTPBasicAuth
-from flask_jwt_extended import (JWTManager, create_access_token, jwt_required, get_jwt_identity)
+from flask_jwt_extended import (JWTManager, create_access_token, jwt_required, get_jwt, get_jwt_identity)
+
+VERIFY_CACHE_SIZE = 1024
+VERIFY_CACHE_TTL = 300.0
+CLAIMS_CACHE_SIZE = 4096
+METRICS_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+REVOCATION_FILE = "revoked_tokens.txt"
+REVOKED_CAPACITY = 65536
+BLOOM_ERROR_RATE = 0.01
+PRUNE_INTERVAL = 60.0
+HASH_WORKERS = 2
+HASH_QUEUE = 32
+LOGIN_RETRY_AFTER = 1
+# (burst, refill per second) of failed password checks, and the number
+# of buckets kept, per username and per client address
+USERNAME_FAILURES = (5, 5 / 60)
+ADDRESS_FAILURES = (20, 20 / 60)
+THROTTLE_BUCKETS = 10000
+
+
+class Throttled(Exception):
+    """Raised when failed logins exhausted a bucket."""
+
+    def __init__(self, retry_after):
+        super().__init__(retry_after)
+        self.retry_after = retry_after
+
+
+class TokenBuckets:
+    """
+    A token bucket per key, holding at most `burst` tokens and refilled
+    at `rate` tokens per second. Only the `size` most recently used
+    buckets are kept, evicting the oldest in O(1); a forgotten bucket is
+    full again.
+    """
+
+    def __init__(self, burst, rate, size=THROTTLE_BUCKETS):
+        self.burst = burst
+        self.rate = rate
+        self.size = size
+        self.buckets = collections.OrderedDict()
+        self.throttled = 0
+
+    def tokens(self, key, now):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            return self.burst
+        return min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+
+    def wait(self, key, now):
+        """Seconds before the key's bucket holds a token."""
+        return max(0.0, (1 - self.tokens(key, now)) / self.rate)
+
+    def add(self, key, count, now):
+        self.buckets[key] = [min(self.burst, self.tokens(key, now) + count),
+                             now]
+        self.buckets.move_to_end(key)
+        while len(self.buckets) > self.size:
+            self.buckets.popitem(last=False)
+
+
+class LoginThrottle:
+    """
+    Failed password checks allowed per username and per client address.
+    A token is taken from both buckets before hashing, and given back if
+    the password was right, so only failures are throttled.
+    """
+
+    def __init__(self):
+        self.usernames = TokenBuckets(*USERNAME_FAILURES)
+        self.addresses = TokenBuckets(*ADDRESS_FAILURES)
+        self.lock = threading.Lock()
+
+    def take(self, username, address):
+        """Take a token for both keys, or raise Throttled."""
+        now = time.monotonic()
+        with self.lock:
+            waits = [(buckets, buckets.wait(key, now)) for buckets, key in
+                     ((self.usernames, username), (self.addresses, address))]
+            if any(wait for _, wait in waits):
+                for buckets, wait in waits:
+                    buckets.throttled += bool(wait)
+                raise Throttled(math.ceil(max(wait for _, wait in waits)))
+            self.usernames.add(username, -1, now)
+            self.addresses.add(address, -1, now)
+
+    def give_back(self, username, address):
+        now = time.monotonic()
+        with self.lock:
+            self.usernames.add(username, 1, now)
+            self.addresses.add(address, 1, now)
+
+    def guard(self, verify, username, address):
+        """Wrap verify(hash, password) to throttle its failures."""
+        def check(pwhash, password):
+            self.take(username, address)
+            valid = None
+            try:
+                valid = verify(pwhash, password)
+                return valid
+            finally:
+                # Given back unless the check ran and failed
+                if valid is not False:
+                    self.give_back(username, address)
+        return check
+
+
+class PoolBusy(Exception):
+    """Raised when a HashPool has no room for another job."""
+
+
+class HashPool:
+    """
+    Dedicated threads for password hashing, which releases the GIL, with
+    at most `queue` jobs waiting: a login storm then takes `workers` cores
+    at most, and the overflow is refused instead of queued.
+    """
+
+    def __init__(self, workers=HASH_WORKERS, queue=HASH_QUEUE):
+        self.executor = ThreadPoolExecutor(workers, "hash")
+        self.slots = threading.BoundedSemaphore(workers + queue)
+        self.rejected = 0
+
+    def run(self, function, *args):
+        """Run function(*args) in the pool, or raise PoolBusy."""
+        if not self.slots.acquire(blocking=False):
+            self.rejected += 1
+            raise PoolBusy()
+        try:
+            future = self.executor.submit(function, *args)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda future: self.slots.release())
+        return future.result()
+
+    def check_password_hash(self, pwhash, password):
+        return self.run(check_password_hash, pwhash, password)
+
+
+class BloomFilter:
+    """
+    Bit array telling that a string was surely not added, or maybe was,
+    wrong about error_rate of the time once capacity strings are added.
+    """
+
+    def __init__(self, capacity, error_rate=BLOOM_ERROR_RATE):
+        self.capacity = capacity
+        self.size = max(8, int(-capacity * math.log(error_rate) /
+                               math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def positions(self, item):
+        # Double hashing: the k positions derive from one 128-bit digest
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        step = int.from_bytes(digest[8:], "little") | 1
+        return [(first + i * step) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        for position in self.positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7))
+                   for position in self.positions(item))
+
+
+class RevocationStore:
+    """
+    Revoked token ids (jti), each kept until its token expires.
+
+    A Bloom filter answers for the tokens that were never revoked, the
+    common case, before the exact jti -> exp dict confirms a revocation.
+    Expired entries are pruned every PRUNE_INTERVAL seconds, by a revoke
+    or a lookup, and the filter is rebuilt from what is left, larger if
+    needed. With a path, revocations are appended to that file, rewritten
+    at each prune, and reloaded on start, skipping malformed lines.
+    """
+
+    def __init__(self, path=None, capacity=REVOKED_CAPACITY):
+        self.path = path
+        self.capacity = capacity
+        self.revoked = {}
+        self.lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    jti, _, exp = line.strip().rpartition(" ")
+                    try:
+                        exp = float(exp)
+                    except ValueError:
+                        continue
+                    if jti:
+                        self.revoked[jti] = exp
+        with self.lock:
+            self.prune()
+
+    def is_revoked(self, jti):
+        # Lookups never wait for the lock: a busy one leaves the prune
+        # to whoever holds it, or to the next lookup
+        if time.time() - self.pruned > PRUNE_INTERVAL and \
+                self.lock.acquire(blocking=False):
+            try:
+                if time.time() - self.pruned > PRUNE_INTERVAL:
+                    self.prune()
+            finally:
+                self.lock.release()
+        return jti in self.bloom and jti in self.revoked
+
+    def revoke(self, jti, exp=None):
+        exp = math.inf if exp is None else exp
+        with self.lock:
+            if time.time() - self.pruned > PRUNE_INTERVAL:
+                self.prune()
+            # In the exact dict first, so a filter hit is always confirmed
+            self.revoked[jti] = exp
+            if len(self.revoked) > self.bloom.capacity:
+                self.rebuild()
+            else:
+                self.bloom.add(jti)
+            if self.path:
+                with open(self.path, "a") as f:
+                    f.write(f"{jti} {exp}\n")
+
+    def prune(self):
+        """Drop the expired tokens; called with the lock held."""
+        now = time.time()
+        self.revoked = {jti: exp for jti, exp in self.revoked.items()
+                        if exp > now}
+        self.rebuild()
+        if self.path:
+            with open(self.path + ".tmp", "w") as f:
+                f.writelines(f"{jti} {exp}\n"
+                             for jti, exp in self.revoked.items())
+            os.replace(self.path + ".tmp", self.path)
+        self.pruned = now
+
+    def rebuild(self):
+        bloom = BloomFilter(max(self.capacity, 2 * len(self.revoked)))
+        for jti in self.revoked:
+            bloom.add(jti)
+        self.bloom = bloom
+
+
+class CachingJWTManager(JWTManager):
+    """
+    JWTManager keeping the claims of validated tokens in an LRU cache,
+    keyed by the SHA-256 of the raw token, so a token presented again
+    skips the signature check and the decoding.
+
+    An entry never outlives the token's exp. Only decoding is cached: the
+    revocation, type and freshness checks still run on every request.
+    """
+
+    def __init__(self, app=None, size=CLAIMS_CACHE_SIZE):
+        self.size = size
+        self.claims = collections.OrderedDict()
+        self.claims_lock = threading.Lock()
+        self.hits = self.misses = 0
+        super().__init__(app)
+
+    def _decode_jwt_from_config(self, encoded_token, csrf_value=None,
+                                allow_expired=False):
+        if csrf_value is not None or allow_expired:
+            return super()._decode_jwt_from_config(encoded_token, csrf_value,
+                                                   allow_expired)
+        digest = hashlib.sha256(encoded_token.encode()).digest()
+        with self.claims_lock:
+            entry = self.claims.get(digest)
+            if entry and (entry[0] is None or entry[0] > time.time()):
+                self.claims.move_to_end(digest)
+                self.hits += 1
+                return dict(entry[1])
+            self.misses += 1
+        claims = super()._decode_jwt_from_config(encoded_token)
+        with self.claims_lock:
+            self.claims[digest] = (claims.get('exp'), dict(claims))
+            self.claims.move_to_end(digest)
+            while len(self.claims) > self.size:
+                self.claims.popitem(last=False)
+        return claims
+
 
 app = Flask(__name__)
 app.config["SECRET_KEY"] = "needs_to_be_changed"
+# The identity is a dict, not the string PyJWT now expects as subject
+app.config["JWT_VERIFY_SUB"] = False
 auth = HTTPBasicAuth()
-jwt = JWTManager(app)
+jwt = CachingJWTManager(app)
+
+class VerifyCache:
+    """
+    LRU cache of successful password checks, each valid for ttl seconds.
+
+    Entries are keyed by an HMAC of the credentials under a per-process
+    random key, so no password is ever stored, and hold the password hash
+    they were checked against: once a password changes they never match.
+    """
+
+    def __init__(self, size=VERIFY_CACHE_SIZE, ttl=VERIFY_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self.key = secrets.token_bytes(32)
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def digest(self, username, password):
+        message = f"{len(username)}:{username}:{password}".encode()
+        return hmac.new(self.key, message, hashlib.sha256).digest()
+
+    def check(self, user, password, verify=check_password_hash):
+        """
+        Check the user's password, hashing it with verify(hash, password)
+        only on a cache miss.
+        """
+        digest = self.digest(user['username'], password)
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(digest)
+            if entry and entry[0] > now and entry[2] == user['password']:
+                self.entries.move_to_end(digest)
+                self.hits += 1
+                return True
+            self.misses += 1
+        if not verify(user['password'], password):
+            return False
+        with self.lock:
+            self.entries[digest] = (now + self.ttl, user['username'],
+                                    user['password'])
+            self.entries.move_to_end(digest)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return True
+
+    def invalidate(self, username):
+        """Drop the entries of a user."""
+        with self.lock:
+            for digest, entry in list(self.entries.items()):
+                if entry[1] == username:
+                    del self.entries[digest]
+
+
+verify_cache = VerifyCache()
+revoked_tokens = RevocationStore()
+hash_pool = HashPool()
+login_throttle = LoginThrottle()
 
 users = {"user1": {"username": "user1", "password": generate_password_hash("password"), "role": "user"},
          "admin1": {"username": "admin1", "password": generate_password_hash("password"), "role": "admin"}}
@@ -14,10 +368,28 @@ users = {"user1": {"username": "user1", "password": generate_password_hash("pass
 @auth.verify_password
 def verify_password(username, password):
     user = users.get(username)
-    if user and check_password_hash(user['password'], password):
+    verify = login_throttle.guard(check_password_hash, username,
+                                  request.remote_addr)
+    try:
+        valid = user and verify_cache.check(user, password, verify)
+    except Throttled as e:
+        abort(throttled_response(e))
+    if valid:
         return user
     return None
 
+
+def throttled_response(error):
+    response = jsonify({"error": "Too many failed logins, retry later"})
+    response.status_code = 429
+    response.headers["Retry-After"] = str(error.retry_after)
+    return response
+
+
+def set_password(username, password):
+    users[username]['password'] = generate_password_hash(password)
+    verify_cache.invalidate(username)
+
 @app.route('/basic-protected')
 @auth.login_required
 def basic_protected():
@@ -29,12 +401,31 @@ def login():
     username = data.get('username')
     password = data.get('password')
     user = users.get(username)
-    if user and check_password_hash(user['password'], password):
+    # Hashing runs in hash_pool; when it is full, ask the client to retry
+    # rather than stall the threads serving authenticated requests.
+    # Repeated failures are throttled before any hashing
+    verify = login_throttle.guard(hash_pool.check_password_hash, username,
+                                  request.remote_addr)
+    try:
+        valid = user and verify_cache.check(user, password, verify)
+    except PoolBusy:
+        return jsonify({"error": "Too many logins, retry later"}), 503, \
+            {"Retry-After": str(LOGIN_RETRY_AFTER)}
+    except Throttled as e:
+        return throttled_response(e)
+    if valid:
         access_token = create_access_token(identity={'username': username, 'role': user['role']})
         return jsonify(access_token=access_token)
 
     return jsonify({"error": "Invalid credentials"}), 401
 
+@app.route('/logout', methods=['POST'])
+@jwt_required()
+def logout():
+    claims = get_jwt()
+    revoked_tokens.revoke(claims['jti'], claims.get('exp'))
+    return jsonify({"message": "Token revoked"})
+
 
 @app.route('/jwt-protected')
 @jwt_required()
@@ -51,6 +442,40 @@ def admin_only():
 
     return "Admin Access: Granted"
 
+@app.route('/metrics')
+def metrics():
+    buckets = (("username", login_throttle.usernames),
+               ("address", login_throttle.addresses))
+    lines = []
+    for name, kind, help_text, samples in (
+            ("verify_cache_hits_total", "counter",
+             "Password checks served from cache", verify_cache.hits),
+            ("verify_cache_misses_total", "counter",
+             "Password checks hashed", verify_cache.misses),
+            ("jwt_claims_cache_hits_total", "counter",
+             "Tokens served from cache", jwt.hits),
+            ("jwt_claims_cache_misses_total", "counter",
+             "Tokens verified and decoded", jwt.misses),
+            ("login_hash_rejected_total", "counter",
+             "Logins refused with a full hash pool", hash_pool.rejected),
+            ("login_throttled_total", "counter",
+             "Password checks refused after too many failures",
+             {key: bucket.throttled for key, bucket in buckets}),
+            ("login_throttle_buckets", "gauge",
+             "Failed-login buckets tracked",
+             {key: len(bucket.buckets) for key, bucket in buckets})):
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+        if isinstance(samples, dict):
+            lines += [f'{name}{{key="{key}"}} {value}'
+                      for key, value in samples.items()]
+        else:
+            lines.append(f"{name} {samples}")
+    return Response("\n".join(lines) + "\n", mimetype=METRICS_TYPE)
+
+@jwt.token_in_blocklist_loader
+def check_if_token_revoked(jwt_header, jwt_payload):
+    return revoked_tokens.is_revoked(jwt_payload['jti'])
+
 @jwt.unauthorized_loader
 def handle_unauthorized_error(err):
     return jsonify({"error": "Missing or invalid token"}), 401
@@ -60,15 +485,17 @@ def handle_invalid_token_error(err):
     return jsonify({"error": "Invalid token"}), 401
 
 @jwt.expired_token_loader
-def handle_expired_token_error(err):
+def handle_expired_token_error(jwt_header, jwt_payload):
     return jsonify({"error": "Token has expired"}), 401
 
 @jwt.revoked_token_loader
-def handle_revoked_token_error(err):
+def handle_revoked_token_error(jwt_header, jwt_payload):
     return jsonify({"error": "Token has been revoked"}), 401
 
 @jwt.needs_fresh_token_loader
-def handle_needs_fresh_token_error(err):
+def handle_needs_fresh_token_error(jwt_header, jwt_payload):
     return jsonify({"error": "Fresh token required"}), 401
 
-app.run()
+if __name__ == "__main__":
+    revoked_tokens = RevocationStore(REVOCATION_FILE)
+    app.run()
@@ -0,0 +1,722 @@
+#!/usr/bin/python3
+"""Unittest for the task_03_http_server header helpers and serving modes
+"""
+import contextlib
+import email.utils
+import http.client
+import io
+import json
+import os
+import re
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import task_03_http_server
+from task_03_http_server import (MODES, ROUTES, AsyncioHTTPServer, Metrics,
+                                 RequestHandler, RouteTable,
+                                 SelectorHTTPServer, ThreadPoolHTTPServer,
+                                 make_server, negotiate_encoding,
+                                 normalize_path, not_modified, parse_range)
+
+ETAG = '"1f-40-abc"'
+MODIFIED = 1700000000.0
+
+
+def start(mode="threaded", **options):
+    # Serve on a free port from a background thread
+    server = make_server(0, mode=mode, log="off", **options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def stop(server):
+    server.shutdown()
+    server.server_close()
+
+
+def exchange(server, data, timeout=5):
+    """Send raw bytes and return all bytes read until the server closes."""
+    address = ("127.0.0.1", server.server_address[1])
+    chunks = []
+    with socket.create_connection(address, timeout=timeout) as sock:
+        sock.sendall(data)
+        while True:
+            try:
+                chunk = sock.recv(65536)
+            except socket.timeout:
+                break
+            if not chunk:
+                break
+            chunks.append(chunk)
+    return b"".join(chunks)
+
+
+def get(server, path, timeout=5):
+    client = http.client.HTTPConnection(
+        "127.0.0.1", server.server_address[1], timeout=timeout)
+    try:
+        client.request("GET", path)
+        response = client.getresponse()
+        return response.status, response.read()
+    finally:
+        client.close()
+
+
+def in_every_mode(data, **options):
+    """Return what each mode answers to raw bytes, without Date headers."""
+    responses = {}
+    for mode in MODES:
+        server = start(mode, **options)
+        try:
+            response = exchange(server, data)
+        finally:
+            stop(server)
+        responses[mode] = re.sub(rb"Date: [^\r]*\r\n", b"", response)
+    return responses
+
+
+class TestRouteTable(unittest.TestCase):
+    def test_normalize_path(self):
+        # Query string, fragment and trailing slash do not matter
+        for path in ("/data", "/data/", "/data?x=1", "/data/#top"):
+            self.assertEqual(normalize_path(path), "/data")
+        self.assertEqual(normalize_path("/?x=1"), "/")
+
+    def test_lookup(self):
+        # Routes are found under any spelling of their path
+        routes = RouteTable()
+        route = routes.register("/hello/", b"Hi")
+        self.assertIs(routes.lookup("/hello?name=x"), route)
+        self.assertIsNone(routes.lookup("/hell"))
+        routes.unregister("/hello")
+        self.assertIsNone(routes.lookup("/hello"))
+
+    def test_pre_encoded(self):
+        # Status line and entity headers are encoded once
+        route = RouteTable().set_json("/x", {"a": 1}, status=201)
+        self.assertEqual(route.status_line, b"HTTP/1.1 201 Created\r\n")
+        self.assertEqual(route.body, b'{"a": 1}')
+        self.assertIn(b"Content-type: application/json\r\n", route.headers)
+        self.assertIn(b"Content-Length: 8\r\n", route.headers)
+
+    def test_runtime_changes(self):
+        # Routes changed while serving are answered right away
+        server = start()
+        try:
+            ROUTES.register("/added", b"v1")
+            self.assertEqual(get(server, "/added"), (200, b"v1"))
+            ROUTES.set_json("/added", [2])
+            self.assertEqual(get(server, "/added/"), (200, b"[2]"))
+            ROUTES.unregister("/added")
+            self.assertEqual(get(server, "/added")[0], 404)
+        finally:
+            ROUTES.unregister("/added")
+            stop(server)
+
+
+def children(pid):
+    with open(f"/proc/{pid}/task/{pid}/children") as f:
+        return set(f.read().split())
+
+
+@unittest.skipUnless(os.path.exists(f"/proc/{os.getpid()}/task"),
+                     "needs /proc to find the worker processes")
+class TestPrefork(unittest.TestCase):
+    def setUp(self):
+        self.supervisor = subprocess.Popen(
+            [sys.executable, "-u", task_03_http_server.__file__,
+             "--port", "0", "--processes", "2", "--log", "off"],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        line = self.supervisor.stdout.readline().decode()
+        self.port = int(re.search(r"port (\d+)", line).group(1))
+
+    def tearDown(self):
+        if self.supervisor.poll() is None:
+            self.supervisor.terminate()
+        self.supervisor.wait(10)
+        self.supervisor.stdout.close()
+        self.supervisor.stderr.close()
+
+    def get(self):
+        client = http.client.HTTPConnection("127.0.0.1", self.port,
+                                            timeout=5)
+        try:
+            client.request("GET", "/status")
+            return client.getresponse().read()
+        finally:
+            client.close()
+
+    def wait_workers(self, count):
+        for _ in range(100):
+            workers = children(self.supervisor.pid)
+            if len(workers) == count:
+                return workers
+            time.sleep(0.05)
+        self.fail(f"expected {count} workers, got {workers}")
+
+    def test_restart(self):
+        # A killed worker is replaced and the port keeps answering
+        workers = self.wait_workers(2)
+        self.assertEqual(self.get(), b"OK")
+        killed = workers.pop()
+        os.kill(int(killed), signal.SIGKILL)
+        for _ in range(100):
+            replaced = children(self.supervisor.pid)
+            if len(replaced) == 2 and killed not in replaced:
+                break
+            time.sleep(0.05)
+        self.assertEqual(len(replaced), 2)
+        self.assertNotIn(killed, replaced)
+        self.assertEqual(self.get(), b"OK")
+
+    def test_graceful_stop(self):
+        # SIGTERM stops the workers, then the supervisor
+        self.wait_workers(2)
+        self.assertEqual(self.get(), b"OK")
+        self.supervisor.send_signal(signal.SIGTERM)
+        self.assertEqual(self.supervisor.wait(10), 0)
+        self.assertEqual(self.supervisor.stderr.read(), b"")
+
+
+class TestParseRange(unittest.TestCase):
+    def test_byte_ranges(self):
+        # Closed and open ranges, clamped to the file
+        self.assertEqual(parse_range("bytes=0-9", 100), (0, 9))
+        self.assertEqual(parse_range("bytes=90-", 100), (90, 99))
+        self.assertEqual(parse_range("bytes=90-200", 100), (90, 99))
+        self.assertEqual(parse_range("Bytes = 5-5", 100), (5, 5))
+
+    def test_suffix_ranges(self):
+        # The last N bytes, or the whole file when N exceeds it
+        self.assertEqual(parse_range("bytes=-10", 100), (90, 99))
+        self.assertEqual(parse_range("bytes=-500", 100), (0, 99))
+        self.assertIs(parse_range("bytes=-0", 100), False)
+        self.assertIs(parse_range("bytes=-10", 0), False)
+
+    def test_unsatisfiable(self):
+        # Ranges starting past the end cannot be served
+        self.assertIs(parse_range("bytes=100-", 100), False)
+        self.assertIs(parse_range("bytes=100-200", 100), False)
+        self.assertIs(parse_range("bytes=0-0", 0), False)
+
+    def test_ignored(self):
+        # Other units, several ranges and bad syntax serve the whole file
+        for header in ("items=0-9", "bytes=0-9,20-29", "bytes=9-0",
+                       "bytes=a-b", "bytes=5", "bytes=-x"):
+            self.assertIsNone(parse_range(header, 100), header)
+
+
+class TestNotModified(unittest.TestCase):
+    def test_if_none_match(self):
+        # Strong and weak tags of the entity, and *, all match
+        self.assertTrue(not_modified(ETAG, MODIFIED, ETAG, None))
+        self.assertTrue(not_modified(ETAG, MODIFIED, f"W/{ETAG}", None))
+        self.assertTrue(not_modified(ETAG, MODIFIED,
+                                     f'"other", W/{ETAG}', None))
+        self.assertTrue(not_modified(ETAG, MODIFIED, "*", None))
+        self.assertFalse(not_modified(ETAG, MODIFIED, '"other"', None))
+        self.assertFalse(not_modified(None, MODIFIED, "*", None))
+
+    def test_if_modified_since(self):
+        # Only used without If-None-Match, and bad dates are ignored
+        since = email.utils.formatdate(MODIFIED, usegmt=True)
+        earlier = email.utils.formatdate(MODIFIED - 1, usegmt=True)
+        self.assertTrue(not_modified(ETAG, MODIFIED, None, since))
+        self.assertFalse(not_modified(ETAG, MODIFIED, None, earlier))
+        self.assertFalse(not_modified(ETAG, MODIFIED, '"other"', since))
+        self.assertFalse(not_modified(ETAG, MODIFIED, None, "yesterday"))
+        self.assertFalse(not_modified(ETAG, MODIFIED, None, None))
+
+
+class TestNegotiateEncoding(unittest.TestCase):
+    def test_preference(self):
+        # The highest weight wins, gzip on ties
+        self.assertEqual(negotiate_encoding("gzip, deflate"), "gzip")
+        self.assertEqual(negotiate_encoding("deflate"), "deflate")
+        self.assertEqual(negotiate_encoding("gzip;q=0.5, deflate"),
+                         "deflate")
+        self.assertEqual(negotiate_encoding("br"), None)
+        self.assertEqual(negotiate_encoding(""), None)
+        self.assertEqual(negotiate_encoding(None), None)
+
+    def test_q_zero(self):
+        # q=0 refuses a coding, also when * would allow it
+        self.assertEqual(negotiate_encoding("gzip;q=0"), None)
+        self.assertEqual(negotiate_encoding("gzip;q=0, *"), "deflate")
+        self.assertEqual(negotiate_encoding("*;q=0"), None)
+        self.assertEqual(negotiate_encoding("gzip;q=x"), None)
+
+    def test_wildcard(self):
+        # * stands for every coding not listed
+        self.assertEqual(negotiate_encoding("*"), "gzip")
+        self.assertEqual(negotiate_encoding("deflate;q=0.9, *;q=0.1"),
+                         "deflate")
+        self.assertEqual(negotiate_encoding("GZIP;Q=0.2, *;q=0.5"),
+                         "deflate")
+
+
+class TestStaticFiles(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        with open(os.path.join(self.directory.name, "a.txt"), "wb") as f:
+            f.write(bytes(range(100)))
+        self.server = make_server(0, workers=2,
+                                  static_dir=self.directory.name,
+                                  log="off")
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.directory.cleanup()
+
+    def get(self, headers=None, path="/static/a.txt"):
+        client = http.client.HTTPConnection(
+            "127.0.0.1", self.server.server_address[1], timeout=5)
+        client.request("GET", path, headers=headers or {})
+        response = client.getresponse()
+        body = response.read()
+        client.close()
+        return response, body
+
+    def test_ranges(self):
+        # Satisfiable ranges get 206, the others 416
+        response, body = self.get({"Range": "bytes=-10"})
+        self.assertEqual(response.status, 206)
+        self.assertEqual(body, bytes(range(90, 100)))
+        self.assertEqual(response.getheader("Content-Range"),
+                         "bytes 90-99/100")
+        response, body = self.get({"Range": "bytes=100-"})
+        self.assertEqual(response.status, 416)
+        self.assertEqual(response.getheader("Content-Range"), "bytes */100")
+
+    def test_if_range(self):
+        # A stale If-Range validator gets the whole file
+        response, _ = self.get()
+        etag = response.getheader("ETag")
+        response, body = self.get({"Range": "bytes=0-9", "If-Range": etag})
+        self.assertEqual((response.status, len(body)), (206, 10))
+        response, body = self.get({"Range": "bytes=0-9",
+                                   "If-Range": '"stale"'})
+        self.assertEqual((response.status, len(body)), (200, 100))
+
+    def test_conditional(self):
+        # Matching validators get an empty 304
+        response, _ = self.get()
+        etag = response.getheader("ETag")
+        response, body = self.get({"If-None-Match": f"W/{etag}"})
+        self.assertEqual((response.status, body), (304, b""))
+        response, body = self.get({"If-Modified-Since":
+                                   response.getheader("Last-Modified")})
+        self.assertEqual((response.status, body), (304, b""))
+
+    def test_missing(self):
+        # Unknown names and paths that cannot exist are 404
+        for path in ("/static/b.txt", "/static/%00", "/static/../x"):
+            response, _ = self.get(path=path)
+            self.assertEqual(response.status, 404, path)
+
+
+class FailingHandler(RequestHandler):
+    def do_GET(self):
+        if self.path == "/boom":
+            raise RuntimeError("boom")
+        super().do_GET()
+
+
+class TestModes(unittest.TestCase):
+    def test_routes(self):
+        # Every mode serves the same endpoints
+        for mode in MODES:
+            server = start(mode)
+            try:
+                with self.subTest(mode=mode):
+                    self.assertEqual(get(server, "/"), (
+                        200, b"Hello, this is a simple API!"))
+                    self.assertEqual(get(server, "/data/"), (
+                        200, b'{"name": "John", "age": 30, '
+                             b'"city": "New York"}'))
+                    self.assertEqual(get(server, "/status"), (200, b"OK"))
+                    self.assertEqual(get(server, "/nope"), (
+                        404, b"Endpoint not found"))
+            finally:
+                stop(server)
+
+    def test_concurrent_clients(self):
+        # Clients served at once all get their answer
+        for mode in MODES:
+            server = start(mode, workers=4)
+            results = []
+
+            def client():
+                results.extend(get(server, "/status") for _ in range(20))
+
+            threads = [threading.Thread(target=client) for _ in range(16)]
+            try:
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+            finally:
+                stop(server)
+            self.assertEqual(results, [(200, b"OK")] * 320, mode)
+
+    def test_full_queue(self):
+        # Beyond workers + queue_size, connections get a 503
+        server = start(workers=1, queue_size=1, idle_timeout=2)
+        address = ("127.0.0.1", server.server_address[1])
+        try:
+            with socket.create_connection(address, timeout=5) as first:
+                # The worker blocks on the unfinished head of first
+                first.sendall(b"GET /status HTTP/1.1\r\n")
+                time.sleep(0.2)
+                with socket.create_connection(address, timeout=5) as second:
+                    second.sendall(b"GET /status HTTP/1.1\r\n"
+                                   b"Connection: close\r\n\r\n")
+                    time.sleep(0.2)
+                    response = exchange(server, b"")
+                    first.sendall(b"Connection: close\r\n\r\n")
+                    self.assertTrue(
+                        first.makefile("rb").read().endswith(b"OK"))
+                    self.assertTrue(
+                        second.makefile("rb").read().endswith(b"OK"))
+            self.assertTrue(response.startswith(
+                b"HTTP/1.1 503 Service Unavailable\r\n"))
+            self.assertIn(b"Retry-After: 1\r\n", response)
+        finally:
+            stop(server)
+
+    def test_handler_error(self):
+        # A raising handler costs its connection, not the server
+        servers = [ThreadPoolHTTPServer(("", 0), FailingHandler, workers=2),
+                   SelectorHTTPServer(("", 0), FailingHandler),
+                   AsyncioHTTPServer(("", 0), FailingHandler)]
+        for server in servers:
+            server.log_writer = None
+            threading.Thread(target=server.serve_forever,
+                             daemon=True).start()
+            try:
+                with contextlib.redirect_stderr(io.StringIO()) as errors:
+                    response = exchange(server, b"GET /boom HTTP/1.1\r\n\r\n")
+                    self.assertEqual(get(server, "/status"), (200, b"OK"))
+            finally:
+                stop(server)
+            name = type(server).__name__
+            self.assertEqual(response, b"", name)
+            self.assertIn("RuntimeError: boom", errors.getvalue(), name)
+
+
+class TestAsyncio(unittest.TestCase):
+    def test_same_responses(self):
+        # The asyncio mode answers byte for byte like the threaded one
+        etag = ROUTES.lookup("/data").identity[2].encode()
+        responses = in_every_mode(
+            b"GET / HTTP/1.1\r\nAccept-Encoding: gzip\r\n\r\n"
+            b"GET /data HTTP/1.1\r\nIf-None-Match: " + etag +
+            b"\r\n\r\nGET /nope HTTP/1.1\r\n\r\n"
+            b"POST /batch HTTP/1.1\r\nContent-Length: 9\r\n\r\n"
+            b'["/data"]'
+            b"GET /status HTTP/1.0\r\n\r\n")
+        self.assertEqual(responses["asyncio"], responses["threaded"])
+        self.assertEqual(re.findall(rb"HTTP/1.[01] (\d+)",
+                                    responses["asyncio"]),
+                         [b"200", b"304", b"404", b"200", b"200"])
+
+    def test_many_idle_connections(self):
+        # Hundreds of idle connections do not delay other clients
+        server = start("asyncio", idle_timeout=10)
+        address = ("127.0.0.1", server.server_address[1])
+        with contextlib.ExitStack() as stack:
+            try:
+                for _ in range(200):
+                    stack.enter_context(
+                        socket.create_connection(address, timeout=5))
+                started = time.monotonic()
+                self.assertEqual(get(server, "/status"), (200, b"OK"))
+                self.assertLess(time.monotonic() - started, 1)
+            finally:
+                stop(server)
+
+
+class TestWire(unittest.TestCase):
+    def assertSameInEveryMode(self, data, **options):
+        responses = in_every_mode(data, **options)
+        for mode, response in responses.items():
+            self.assertEqual(response, responses["threaded"], mode)
+        return responses["threaded"]
+
+    def test_invalid_content_length(self):
+        # Every mode answers 400 and closes the connection
+        for value in (b"abc", b"-1", b"+5", b"1_0", b""):
+            with self.subTest(value=value):
+                response = self.assertSameInEveryMode(
+                    b"POST /batch HTTP/1.1\r\nContent-Length: " + value +
+                    b"\r\n\r\n[]GET /status HTTP/1.1\r\n\r\n")
+                self.assertTrue(response.startswith(
+                    b"HTTP/1.1 400 Bad Request\r\n"))
+                self.assertIn(b"Connection: close\r\n", response)
+                self.assertEqual(response.count(b"HTTP/1.1 "), 1)
+
+    def test_bodies_of_any_method(self):
+        # A body is skipped whatever the method, pipelined requests follow
+        response = self.assertSameInEveryMode(
+            b"GET /status HTTP/1.1\r\nContent-Length: 5\r\n\r\nhello"
+            b"POST /batch HTTP/1.1\r\nContent-Length: 11\r\n\r\n"
+            b'["/status"]'
+            b"GET /status HTTP/1.1\r\nConnection: close\r\n\r\n")
+        self.assertEqual(re.findall(rb"HTTP/1.1 (\d+)", response),
+                         [b"200", b"200", b"200"])
+        self.assertIn(b'"path": "/status"', response)
+
+    def test_chunked_body(self):
+        # Chunked bodies are refused and the connection closed
+        response = self.assertSameInEveryMode(
+            b"POST /batch HTTP/1.1\r\nTransfer-Encoding: chunked\r\n"
+            b"\r\n2\r\n[]\r\n0\r\n\r\nGET /status HTTP/1.1\r\n\r\n")
+        self.assertTrue(response.startswith(
+            b"HTTP/1.1 411 Length Required\r\n"))
+        self.assertIn(b"Connection: close\r\n", response)
+        self.assertEqual(response.count(b"HTTP/1.1 "), 1)
+
+
+class TestKeepAlive(unittest.TestCase):
+    def test_reuse(self):
+        # Several requests go over one connection in every mode
+        for mode in MODES:
+            server = start(mode)
+            client = http.client.HTTPConnection(
+                "127.0.0.1", server.server_address[1], timeout=5)
+            try:
+                client.connect()
+                sock = client.sock
+                for path in ("/", "/data", "/status", "/nope"):
+                    client.request("GET", path)
+                    client.getresponse().read()
+                self.assertIs(client.sock, sock, mode)
+            finally:
+                client.close()
+                stop(server)
+
+    def test_pipelining(self):
+        # Pipelined requests are answered in order, the same in every mode
+        responses = in_every_mode(
+            b"GET / HTTP/1.1\r\n\r\nGET /data HTTP/1.1\r\n\r\n"
+            b"GET /status HTTP/1.1\r\nConnection: close\r\n\r\n")
+        for mode, response in responses.items():
+            self.assertEqual(response, responses["threaded"], mode)
+        bodies = re.split(rb"HTTP/1.1 200 OK\r\n", responses["threaded"])
+        self.assertEqual(len(bodies), 4)
+        self.assertTrue(bodies[1].endswith(b"simple API!"))
+        self.assertTrue(bodies[2].endswith(b'"New York"}'))
+        self.assertTrue(bodies[3].endswith(b"\r\n\r\nOK"))
+
+    def test_request_cap(self):
+        # The max_requests-th response closes the connection
+        responses = in_every_mode(b"GET /status HTTP/1.1\r\n\r\n" * 3,
+                                  max_requests=2)
+        for mode, response in responses.items():
+            self.assertEqual(response.count(b"HTTP/1.1 200 OK"), 2, mode)
+            self.assertEqual(response.count(b"Connection: close"), 1, mode)
+            self.assertTrue(response.endswith(
+                b"Connection: close\r\n\r\nOK"), mode)
+
+    def test_idle_timeout(self):
+        # Idle connections are closed after idle_timeout in every mode
+        for mode in MODES:
+            server = start(mode, idle_timeout=0.3)
+            address = ("127.0.0.1", server.server_address[1])
+            try:
+                with socket.create_connection(address, timeout=5) as sock:
+                    sock.sendall(b"GET /status HTTP/1.1\r\n\r\n")
+                    reader = sock.makefile("rb")
+                    started = time.monotonic()
+                    self.assertTrue(reader.read().endswith(b"OK"), mode)
+                    self.assertLess(time.monotonic() - started, 3, mode)
+            finally:
+                stop(server)
+
+    def test_idle_connections_free_workers(self):
+        # Idle keep-alive clients do not hold the worker threads
+        server = start(workers=1, idle_timeout=10)
+        clients = []
+        try:
+            for _ in range(4):
+                client = http.client.HTTPConnection(
+                    "127.0.0.1", server.server_address[1], timeout=5)
+                client.request("GET", "/status")
+                client.getresponse().read()
+                clients.append(client)
+            started = time.monotonic()
+            self.assertEqual(get(server, "/status"), (200, b"OK"))
+            self.assertLess(time.monotonic() - started, 1)
+            for client in clients:
+                client.request("GET", "/data")
+                self.assertEqual(client.getresponse().status, 200)
+        finally:
+            for client in clients:
+                client.close()
+            stop(server)
+
+    def test_no_idle_timeout(self):
+        # With idle_timeout 0 a slow client is still answered
+        server = start(idle_timeout=0)
+        address = ("127.0.0.1", server.server_address[1])
+        try:
+            with socket.create_connection(address, timeout=5) as sock:
+                time.sleep(0.2)
+                sock.sendall(b"GET /status HTTP/1.1\r\n"
+                             b"Connection: close\r\n\r\n")
+                response = sock.makefile("rb").read()
+        finally:
+            stop(server)
+        self.assertTrue(response.startswith(b"HTTP/1.1 200 OK"))
+        self.assertTrue(response.endswith(b"\r\n\r\nOK"))
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.metrics = task_03_http_server.RequestHandler.metrics
+        task_03_http_server.RequestHandler.metrics = Metrics()
+
+    def tearDown(self):
+        task_03_http_server.RequestHandler.metrics = self.metrics
+
+    def test_counts_and_latency(self):
+        # Requests are counted by path and code, with a latency histogram
+        for mode in MODES:
+            task_03_http_server.RequestHandler.metrics = Metrics()
+            server = start(mode)
+            try:
+                for path in ("/status", "/status/", "/nope"):
+                    get(server, path)
+                status, body = get(server, "/metrics")
+            finally:
+                stop(server)
+            text = body.decode()
+            self.assertEqual(status, 200, mode)
+            self.assertIn('http_requests_total{path="/status",code="200"} 2',
+                          text)
+            self.assertIn('http_requests_total{path="other",code="404"} 1',
+                          text)
+            # The /metrics request itself is being served
+            self.assertIn("http_requests_in_flight 1", text)
+            self.assertIn('http_request_duration_seconds_bucket'
+                          '{path="/status",le="+Inf"} 2', text)
+            self.assertIn('http_request_duration_seconds_count'
+                          '{path="/status"} 2', text)
+
+    def test_unanswered_requests(self):
+        # A request without a response only leaves the in-flight gauge
+        metrics = Metrics()
+        for status in (404, None, 200):
+            metrics.begin()
+            metrics.end("/x", status, 0.001)
+        text = metrics.render().decode()
+        self.assertIn('http_requests_total{path="/x",code="404"} 1', text)
+        self.assertIn("http_requests_in_flight 0", text)
+        self.assertNotIn("None", text)
+
+    def test_body_timeout(self):
+        # /metrics still renders after a request body timed out
+        server = start(idle_timeout=0.3)
+        try:
+            exchange(server, b"GET /nope HTTP/1.1\r\n\r\n", timeout=1)
+            exchange(server, b"POST /batch HTTP/1.1\r\n"
+                             b"Content-Length: 10\r\n\r\n[", timeout=1)
+            response = exchange(server, b"GET /metrics HTTP/1.1\r\n"
+                                        b"Connection: close\r\n\r\n")
+        finally:
+            stop(server)
+        self.assertTrue(response.startswith(b"HTTP/1.1 200 OK"))
+        self.assertIn(b'path="other",code="404"', response)
+        self.assertNotIn(b"None", response)
+
+    def test_no_validators(self):
+        # Live counters are never answered with 304
+        server = start()
+        try:
+            response = exchange(server, b"GET /metrics HTTP/1.1\r\n"
+                                b"If-Modified-Since: Fri, 01 Jan 2100 "
+                                b"00:00:00 GMT\r\nIf-None-Match: *\r\n"
+                                b"Connection: close\r\n\r\n")
+        finally:
+            stop(server)
+        self.assertTrue(response.startswith(b"HTTP/1.1 200 OK"))
+        self.assertNotIn(b"ETag:", response)
+        self.assertNotIn(b"Last-Modified:", response)
+
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        self.server = start()
+
+    def tearDown(self):
+        stop(self.server)
+
+    def request(self, method, path, body=None):
+        client = http.client.HTTPConnection(
+            "127.0.0.1", self.server.server_address[1], timeout=5)
+        try:
+            client.request(method, path, body=body)
+            response = client.getresponse()
+            return response.status, json.loads(response.read())
+        finally:
+            client.close()
+
+    def test_get(self):
+        # Paths come from repeated path= or comma separated paths=
+        status, data = self.request("GET", "/batch?path=/data&path=/nope")
+        self.assertEqual(status, 200)
+        self.assertEqual(data, {"responses": [
+            {"path": "/data", "status": 200,
+             "content_type": "application/json",
+             "body": {"name": "John", "age": 30, "city": "New York"}},
+            {"path": "/nope", "status": 404, "content_type": "text/plain",
+             "body": "Endpoint not found"}]})
+        status, data = self.request("GET", "/batch?paths=/,/status")
+        self.assertEqual([entry["body"] for entry in data["responses"]],
+                         ["Hello, this is a simple API!", "OK"])
+
+    def test_post(self):
+        # A JSON list of paths, or an object holding one
+        for body in ('["/status", "/"]', '{"paths": ["/status", "/"]}'):
+            status, data = self.request("POST", "/batch", body)
+            self.assertEqual(status, 200)
+            self.assertEqual([entry["path"] for entry in data["responses"]],
+                             ["/status", "/"])
+
+    def test_errors(self):
+        # Malformed and oversized batches are refused
+        too_many = json.dumps(["/status"] * 33)
+        for body, status in (("[", 400), ('{"paths": 1}', 400),
+                             ("[1]", 400), (too_many, 400),
+                             ("[" + " " * 65536 + "]", 413)):
+            with self.subTest(body=body[:20]):
+                self.assertEqual(self.request("POST", "/batch", body)[0],
+                                 status)
+        client = http.client.HTTPConnection(
+            "127.0.0.1", self.server.server_address[1], timeout=5)
+        client.request("POST", "/status", body="[]")
+        self.assertEqual(client.getresponse().status, 501)
+        client.close()
+
+    def test_no_validators(self):
+        # A batch is built per request and never answered with 304
+        response = exchange(self.server, b"GET /batch?path=/status HTTP/1.1"
+                            b"\r\nIf-Modified-Since: Fri, 01 Jan 2100 "
+                            b"00:00:00 GMT\r\nIf-None-Match: *\r\n"
+                            b"Connection: close\r\n\r\n")
+        self.assertTrue(response.startswith(b"HTTP/1.1 200 OK"))
+        self.assertNotIn(b"ETag:", response)
+        self.assertIn(b'"path": "/status"', response)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,405 @@
+#!/usr/bin/python3
+"""Unittest for the task_04_flask user store
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import task_04_flask
+from task_04_flask import ChangeFeed, SQLiteBackend, UserStore, app
+
+WRITERS = 64
+USERS_PER_WRITER = 500
+
+
+def run_writers(target):
+    # Start WRITERS threads together and wait for all of them
+    barrier = threading.Barrier(WRITERS)
+    errors = []
+
+    def run(number):
+        barrier.wait()
+        try:
+            target(number)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(number,))
+               for number in range(WRITERS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return errors
+
+
+class TestUserStore(unittest.TestCase):
+    def setUp(self):
+        # Switch threads as often as possible to expose races
+        self.interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+
+    def tearDown(self):
+        sys.setswitchinterval(self.interval)
+
+    def test_put_and_get(self):
+        # A stored user is found, an unknown one is not
+        store = UserStore()
+        store.put({"username": "jane", "age": 28})
+        self.assertEqual(store.get("jane"), {"username": "jane", "age": 28,
+                                             "name": None, "city": None})
+        self.assertIsNone(store.get("john"))
+        self.assertIn("jane", store)
+        self.assertEqual(len(store), 1)
+
+    def test_rejects_non_string_username(self):
+        # A bad username fails the whole batch before any shard changes
+        store = UserStore(shards=4)
+        store.put({"username": "jane"})
+        with self.assertRaises(TypeError):
+            store.put_many([{"username": "john"}, {"username": 7}])
+        self.assertEqual(list(store.iter_names()), ["jane"])
+        self.assertEqual(len(store), 1)
+
+    def test_names_sorted_across_shards(self):
+        # Names come out in order, whatever shard they live in
+        store = UserStore(shards=4)
+        store.put_many([{"username": f"u{n:03}"} for n in range(100)])
+        store.put({"username": "a"})
+        expected = ["a"] + [f"u{n:03}" for n in range(100)]
+        self.assertEqual(list(store.iter_names()), expected)
+        self.assertEqual(list(store.iter_names("u049", 3)),
+                         ["u050", "u051", "u052"])
+
+    def test_find(self):
+        # Filtered queries follow updates of city and age
+        store = UserStore(shards=4)
+        cities = ["Paris", "Lyon", "Nice"]
+        store.put_many([{"username": f"u{n:02}", "age": n,
+                         "city": cities[n % 3]} for n in range(60)])
+        store.put({"username": "u03", "age": 70, "city": "Lyon"})
+        store.put({"username": "x", "age": "old", "city": None})
+
+        def names(**filters):
+            return [user["username"] for user in store.find(**filters)]
+
+        self.assertEqual(names(city="Paris"),
+                         [f"u{n:02}" for n in range(0, 60, 3) if n != 3])
+        self.assertEqual(names(age_min=57), ["u03", "u57", "u58", "u59"])
+        self.assertEqual(names(age_min=10, age_max=12),
+                         ["u10", "u11", "u12"])
+        self.assertEqual(names(city="Lyon", age_max=7), ["u01", "u04", "u07"])
+        self.assertEqual(names(city="Lyon", age_min=65), ["u03"])
+        self.assertEqual(names(city="Rome"), [])
+
+    def test_no_lost_updates_single_puts(self):
+        # 64 writers adding distinct users one at a time
+        store = UserStore()
+
+        def write(number):
+            for n in range(USERS_PER_WRITER):
+                store.put({"username": f"w{number}-{n}", "age": number})
+
+        self.assertEqual(run_writers(write), [])
+        self.assertEqual(len(store), WRITERS * USERS_PER_WRITER)
+        names = list(store.iter_names())
+        self.assertEqual(len(names), WRITERS * USERS_PER_WRITER)
+        self.assertEqual(names, sorted(set(names)))
+
+    def test_no_lost_updates_batches(self):
+        # 64 writers adding overlapping batches
+        store = UserStore()
+
+        def write(number):
+            for start in range(0, USERS_PER_WRITER, 50):
+                store.put_many([{"username": f"u{n}", "age": number}
+                                for n in range(start, start + 100)])
+
+        self.assertEqual(run_writers(write), [])
+        self.assertEqual(len(store), USERS_PER_WRITER + 50)
+        self.assertEqual(list(store.iter_names()),
+                         sorted(f"u{n}" for n in range(USERS_PER_WRITER + 50)))
+
+    def test_last_write_wins(self):
+        # Every writer updates the same users; each ends up whole
+        store = UserStore()
+
+        def write(number):
+            for n in range(100):
+                store.put({"username": f"u{n}", "name": str(number),
+                           "age": number})
+
+        self.assertEqual(run_writers(write), [])
+        self.assertEqual(len(store), 100)
+        for n in range(100):
+            user = store.get(f"u{n}")
+            self.assertEqual(user["name"], str(user["age"]))
+
+
+class TestChangeFeed(unittest.TestCase):
+    def test_wait(self):
+        # Readers get the changes past their sequence number
+        feed = ChangeFeed(size=3)
+        feed.publish([("add", "a"), ("add", "b")])
+        self.assertEqual(feed.wait(0, 0), ([(1, "add", "a"), (2, "add", "b")],
+                                           2, False))
+        self.assertEqual(feed.wait(1, 0), ([(2, "add", "b")], 2, False))
+        self.assertEqual(feed.wait(2, 0), ([], 2, False))
+
+    def test_wait_wakes_up(self):
+        # A waiting reader returns as soon as a change is published
+        feed = ChangeFeed()
+        timer = threading.Timer(0.05, feed.publish, [[("update", "a")]])
+        timer.start()
+        self.assertEqual(feed.wait(0, 5), ([(1, "update", "a")], 1, False))
+        timer.join()
+
+    def test_reset(self):
+        # Readers behind the buffer, or ahead of it, must reload
+        feed = ChangeFeed(size=2)
+        feed.publish([("add", "a"), ("add", "b"), ("add", "c")])
+        self.assertEqual(feed.wait(0, 0), ([], 3, True))
+        self.assertEqual(feed.wait(1, 0), ([(2, "add", "b"), (3, "add", "c")],
+                                           3, False))
+        self.assertEqual(feed.wait(7, 0), ([], 3, True))
+
+
+class TestSQLiteBackend(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "users.db")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_users_survive_restart(self):
+        # Users written before close are loaded by the next store
+        store = UserStore(backend=SQLiteBackend(self.path))
+        store.put_many([{"username": f"u{n}", "age": n} for n in range(100)])
+        store.put({"username": "u5", "age": 55})
+        store.close()
+        store = UserStore(backend=SQLiteBackend(self.path))
+        self.assertEqual(len(store), 100)
+        self.assertEqual(store.get("u5")["age"], 55)
+        self.assertEqual(list(store.iter_names("u97")), ["u98", "u99"])
+        store.close()
+
+    def test_flush_interval(self):
+        # Queued users reach the database without closing the store
+        backend = SQLiteBackend(self.path, flush_interval=0.01)
+        store = UserStore(backend=backend)
+        store.put({"username": "jane"})
+        reader = SQLiteBackend(self.path)
+        for _ in range(100):
+            if list(reader.load()):
+                break
+            threading.Event().wait(0.01)
+        self.assertEqual([user["username"] for user in reader.load()],
+                         ["jane"])
+        reader.close()
+        store.close()
+
+    def test_max_pending(self):
+        # Concurrent writers never queue more than max_pending users
+        backend = SQLiteBackend(self.path, flush_interval=60, max_pending=50)
+        store = UserStore(backend=backend)
+
+        def write(number):
+            for n in range(20):
+                store.put({"username": f"w{number}-{n}"})
+                self.assertLessEqual(len(backend.pending), 50 + WRITERS)
+
+        self.assertEqual(run_writers(write), [])
+        store.close()
+        store = UserStore(backend=SQLiteBackend(self.path))
+        self.assertEqual(len(store), WRITERS * 20)
+        store.close()
+
+    def test_backpressure_outside_shard_lock(self):
+        # A writer waiting for a slow flush does not block the shard
+        backend = SQLiteBackend(self.path, flush_interval=60, max_pending=1)
+        release = threading.Event()
+        flush = backend.flush
+
+        def slow_flush(batch):
+            release.wait(5)
+            flush(batch)
+
+        backend.flush = slow_flush
+        store = UserStore(shards=1, backend=backend)
+        store.put({"username": "jane", "city": "Paris"})
+        writer = threading.Thread(target=store.put,
+                                  args=({"username": "john"},))
+        writer.start()
+        writer.join(0.2)
+        self.assertTrue(writer.is_alive())
+        started = time.monotonic()
+        self.assertEqual([user["username"] for user in store.find("Paris")],
+                         ["jane"])
+        self.assertEqual(store.body("jane", lambda user: b"x"), b"x")
+        self.assertLess(time.monotonic() - started, 1)
+        release.set()
+        writer.join()
+        store.close()
+
+
+class TestRoutes(unittest.TestCase):
+    def setUp(self):
+        task_04_flask.users = UserStore()
+
+    def test_concurrent_add_user(self):
+        # 64 clients posting users through the Flask routes
+        def write(number):
+            client = app.test_client()
+            for n in range(20):
+                response = client.post("/add_user", json={
+                    "username": f"w{number}-{n}", "city": "Paris"})
+                if response.status_code != 201:
+                    raise AssertionError(response.status_code)
+
+        self.assertEqual(run_writers(write), [])
+        client = app.test_client()
+        self.assertEqual(len(client.get("/data").json), WRITERS * 20)
+        response = client.get("/users/w63-19")
+        self.assertEqual(response.json["city"], "Paris")
+        self.assertEqual(client.get("/users/nobody").status_code, 404)
+
+    def test_add_user_non_string_username(self):
+        # /add_user rejects a username that is not a string
+        client = app.test_client()
+        response = client.post("/add_user", json={"username": 7})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(client.get("/data").json, [])
+
+    def test_add_users_rejects_bad_usernames(self):
+        # Rows with a non-string username are rejected, the others stored
+        client = app.test_client()
+        body = "\n".join(['{"username": "jane"}', '{"username": ["x"]}',
+                          '{"username": 7}', '{"username": "john"}'])
+        response = client.post("/add_users", data=body,
+                               content_type="application/x-ndjson")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json["accepted"], 2)
+        self.assertEqual(response.json["rejected"], 2)
+        self.assertEqual([error["record"]
+                          for error in response.json["errors"]], [2, 3])
+        self.assertEqual(response.json["errors"][0]["error"],
+                         "Username must be a string")
+        self.assertEqual(client.get("/data").json, ["jane", "john"])
+
+    def test_add_users_record_size(self):
+        # An oversized record is rejected and ends the import
+        client = app.test_client()
+        huge = b"x" * task_04_flask.MAX_RECORD_SIZE
+        for content_type, body in (
+                ("application/json", b'[{"username": "jane"}, '
+                 b'{"username": "' + huge + b'"}, {"username": "john"}]'),
+                ("application/x-ndjson", b'{"username": "jane"}\n'
+                 b'{"username": "' + huge + b'"}\n{"username": "john"}')):
+            response = client.post("/add_users", data=body,
+                                   content_type=content_type)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json["accepted"], 1, content_type)
+            self.assertEqual(response.json["rejected"], 1, content_type)
+            self.assertIn("Record larger than",
+                          response.json["errors"][0]["error"])
+        self.assertEqual(client.get("/data").json, ["jane"])
+
+    def test_cached_user_body(self):
+        # A user's cached body is replaced when the user is overwritten
+        client = app.test_client()
+        client.post("/add_user", json={"username": "jane", "age": 28})
+        self.assertEqual(client.get("/users/jane").json["age"], 28)
+        client.post("/add_user", json={"username": "jane", "age": 29})
+        self.assertEqual(client.get("/users/jane").json["age"], 29)
+
+    def test_data_etag(self):
+        # /data answers 304 until a user is added
+        client = app.test_client()
+        client.post("/add_user", json={"username": "jane"})
+        response = client.get("/data")
+        self.assertEqual(response.json, ["jane"])
+        etag = response.headers["ETag"]
+        response = client.get("/data", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+        client.post("/add_user", json={"username": "john"})
+        response = client.get("/data", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json, ["jane", "john"])
+        self.assertNotEqual(response.headers["ETag"], etag)
+
+    def test_changes_long_poll(self):
+        # /changes?since= returns the adds and updates after since
+        client = app.test_client()
+        client.post("/add_user", json={"username": "jane", "age": 28})
+        client.post("/add_user", json={"username": "jane", "age": 29})
+        response = client.get("/changes?since=0&timeout=0")
+        self.assertEqual(response.json["next"], 2)
+        self.assertFalse(response.json["reset"])
+        self.assertEqual([(change["seq"], change["type"],
+                           change["user"]["age"])
+                          for change in response.json["changes"]],
+                         [(1, "add", 28), (2, "update", 29)])
+        response = client.get("/changes?timeout=0")
+        self.assertEqual(response.json["changes"], [])
+        self.assertEqual(client.get("/changes?since=x").status_code, 400)
+        for timeout in ("nan", "inf", "-inf"):
+            self.assertEqual(client.get(f"/changes?timeout={timeout}")
+                             .status_code, 400, timeout)
+
+    def test_changes_event_stream(self):
+        # Changes are streamed as Server-Sent Events
+        client = app.test_client()
+        client.post("/add_user", json={"username": "jane"})
+        response = client.get("/changes?since=0", buffered=False,
+                              headers={"Accept": "text/event-stream"})
+        self.assertEqual(response.mimetype, "text/event-stream")
+        events = iter(response.response)
+        self.assertEqual(next(events), b": heartbeat\n\n")
+        event = next(events).decode()
+        response.close()
+        self.assertEqual(event.splitlines()[:2], ["id: 1", "event: add"])
+        self.assertIn('"username": "jane"', event)
+
+    def test_users_batch(self):
+        # /users/batch returns the found users in order and the missing ones
+        client = app.test_client()
+        for name in ("jane", "john"):
+            client.post("/add_user", json={"username": name, "age": 30})
+        response = client.get("/users/batch?username=john&username=x"
+                              "&username=jane&username=john")
+        self.assertEqual(response.json["missing"], ["x"])
+        self.assertEqual([user["username"] for user in response.json["users"]],
+                         ["john", "jane"])
+        response = client.post("/users/batch", json={"usernames": ["jane"]})
+        self.assertEqual(response.json, {"missing": [], "users": [
+            {"username": "jane", "name": None, "age": 30, "city": None}]})
+        response = client.post("/users/batch", json=["y"])
+        self.assertEqual(response.json, {"missing": ["y"], "users": []})
+        too_many = [f"u{n}" for n in range(task_04_flask.MAX_BATCH_SIZE + 1)]
+        response = client.post("/users/batch", json=too_many)
+        self.assertEqual(response.status_code, 400)
+        response = client.post("/users/batch", json={"usernames": "jane"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_find_users(self):
+        # /users filters by city and age range
+        client = app.test_client()
+        for n, city in enumerate(["Paris", "Lyon", "Paris"]):
+            client.post("/add_user", json={"username": f"u{n}",
+                                           "age": 20 + n, "city": city})
+        response = client.get("/users?city=Paris&age_min=21")
+        self.assertEqual(response.json, [{"username": "u2", "age": 22,
+                                          "city": "Paris", "name": None}])
+        response = client.get("/users?age_max=21")
+        self.assertEqual([user["username"] for user in response.json],
+                         ["u0", "u1"])
+        self.assertEqual(client.get("/users").status_code, 400)
+        self.assertEqual(client.get("/users?age_min=x").status_code, 400)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,295 @@
+#!/usr/bin/python3
+"""Unittest for the task_05_basic_security caches and throttles
+"""
+import base64
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from werkzeug.security import generate_password_hash
+
+import task_05_basic_security
+from task_05_basic_security import (BloomFilter, HashPool, LoginThrottle,
+                                    PoolBusy, RevocationStore, Throttled,
+                                    TokenBuckets, VerifyCache, app, jwt)
+
+
+class TestVerifyCache(unittest.TestCase):
+    def setUp(self):
+        self.calls = 0
+        self.user = {"username": "jane",
+                     "password": generate_password_hash("secret")}
+
+    def verify(self, pwhash, password):
+        self.calls += 1
+        return password == "secret"
+
+    def test_hit_skips_hashing(self):
+        # Only the first right password and the wrong ones are hashed
+        cache = VerifyCache()
+        self.assertTrue(cache.check(self.user, "secret", self.verify))
+        self.assertTrue(cache.check(self.user, "secret", self.verify))
+        self.assertFalse(cache.check(self.user, "wrong", self.verify))
+        self.assertFalse(cache.check(self.user, "wrong", self.verify))
+        self.assertEqual(self.calls, 3)
+        self.assertEqual((cache.hits, cache.misses), (1, 3))
+
+    def test_invalidate(self):
+        # Dropped entries, and entries for an old hash, are hashed again
+        cache = VerifyCache()
+        cache.check(self.user, "secret", self.verify)
+        cache.invalidate("jane")
+        cache.check(self.user, "secret", self.verify)
+        self.assertEqual(self.calls, 2)
+        self.user["password"] = generate_password_hash("secret")
+        cache.check(self.user, "secret", self.verify)
+        self.assertEqual(self.calls, 3)
+
+    def test_expiry_and_size(self):
+        # Entries expire after ttl and at most size entries are kept
+        cache = VerifyCache(size=2, ttl=0)
+        cache.check(self.user, "secret", self.verify)
+        cache.check(self.user, "secret", self.verify)
+        self.assertEqual(self.calls, 2)
+        for n in range(5):
+            cache.check({"username": f"u{n}", "password": "x"}, "secret",
+                        self.verify)
+        self.assertEqual(len(cache.entries), 2)
+
+
+class TestBloomFilter(unittest.TestCase):
+    def test_no_false_negatives(self):
+        # Every added item is found, and few others are
+        bloom = BloomFilter(1000)
+        for n in range(1000):
+            bloom.add(f"jti-{n}")
+        self.assertTrue(all(f"jti-{n}" in bloom for n in range(1000)))
+        false_positives = sum(f"other-{n}" in bloom for n in range(10000))
+        self.assertLess(false_positives, 300)
+
+
+class TestRevocationStore(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "revoked.txt")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_revoke(self):
+        # Revoked ids are found, also past the filter's capacity
+        store = RevocationStore(capacity=8)
+        for n in range(100):
+            store.revoke(f"jti-{n}")
+        self.assertTrue(all(store.is_revoked(f"jti-{n}")
+                            for n in range(100)))
+        self.assertFalse(store.is_revoked("jti-100"))
+
+    def test_survives_reload(self):
+        # Unexpired revocations are reloaded, expired ones are dropped
+        store = RevocationStore(self.path)
+        store.revoke("forever")
+        store.revoke("later", time.time() + 3600)
+        store.revoke("expired", time.time() - 1)
+        store = RevocationStore(self.path)
+        self.assertTrue(store.is_revoked("forever"))
+        self.assertTrue(store.is_revoked("later"))
+        self.assertFalse(store.is_revoked("expired"))
+        with open(self.path) as f:
+            self.assertEqual(len(f.readlines()), 2)
+
+    def test_skips_malformed_lines(self):
+        # Lines that do not hold a jti and an exp are ignored on load
+        with open(self.path, "w") as f:
+            f.write("good inf\n\nbad\nworse soon\n 1.0\nlater 9e99\n")
+        store = RevocationStore(self.path)
+        self.assertEqual(store.revoked, {"good": float("inf"),
+                                         "later": 9e99})
+
+    def test_lookup_prunes(self):
+        # Lookups drop expired tokens once PRUNE_INTERVAL has passed
+        store = RevocationStore()
+        store.revoke("expired", time.time() + 0.01)
+        time.sleep(0.02)
+        self.assertIn("expired", store.revoked)
+        store.pruned -= task_05_basic_security.PRUNE_INTERVAL
+        self.assertFalse(store.is_revoked("expired"))
+        self.assertEqual(store.revoked, {})
+
+
+class TestHashPool(unittest.TestCase):
+    def test_full_pool_is_refused(self):
+        # Jobs beyond workers + queue raise PoolBusy instead of waiting
+        pool = HashPool(workers=1, queue=0)
+        started = threading.Event()
+        release = threading.Event()
+
+        def block():
+            started.set()
+            release.wait()
+
+        thread = threading.Thread(target=pool.run, args=(block,))
+        thread.start()
+        started.wait()
+        self.assertRaises(PoolBusy, pool.run, len, "x")
+        self.assertEqual(pool.rejected, 1)
+        release.set()
+        thread.join()
+        self.assertEqual(pool.run(len, "abc"), 3)
+
+
+class TestTokenBuckets(unittest.TestCase):
+    def test_lockout_and_refill(self):
+        # A drained bucket waits for its refill, one token per 1 / rate
+        buckets = TokenBuckets(3, 0.5)
+        for _ in range(3):
+            self.assertEqual(buckets.wait("jane", 10.0), 0)
+            buckets.add("jane", -1, 10.0)
+        self.assertEqual(buckets.wait("jane", 10.0), 2.0)
+        self.assertEqual(buckets.wait("jane", 11.0), 1.0)
+        self.assertEqual(buckets.wait("jane", 12.0), 0)
+        self.assertEqual(buckets.tokens("jane", 100.0), 3)
+
+    def test_eviction_is_bounded(self):
+        # Only the most recently used buckets are kept
+        buckets = TokenBuckets(3, 0.5, size=10)
+        for n in range(100):
+            buckets.add(f"u{n}", -1, 0.0)
+            self.assertLessEqual(len(buckets.buckets), 10)
+        buckets.add("u90", -1, 0.0)
+        buckets.add("new", -1, 0.0)
+        self.assertIn("u90", buckets.buckets)
+        self.assertNotIn("u91", buckets.buckets)
+        # A forgotten bucket is full again
+        self.assertEqual(buckets.tokens("u0", 0.0), 3)
+
+
+class TestLoginThrottle(unittest.TestCase):
+    def test_failures_lock_out(self):
+        # The burst of failed checks is allowed, then refused
+        throttle = LoginThrottle()
+        verify = throttle.guard(lambda pwhash, password: False, "jane",
+                                "10.0.0.1")
+        burst = throttle.usernames.burst
+        for _ in range(burst):
+            self.assertFalse(verify("hash", "wrong"))
+        with self.assertRaises(Throttled) as caught:
+            verify("hash", "wrong")
+        self.assertGreater(caught.exception.retry_after, 0)
+        self.assertEqual(throttle.usernames.throttled, 1)
+        # Another username from another address is not affected
+        verify = throttle.guard(lambda pwhash, password: False, "john",
+                                "10.0.0.2")
+        self.assertFalse(verify("hash", "wrong"))
+
+    def test_correct_password_gives_back(self):
+        # Right passwords and errors never drain the buckets
+        throttle = LoginThrottle()
+        verify = throttle.guard(lambda pwhash, password: True, "jane",
+                                "10.0.0.1")
+        for _ in range(3 * throttle.usernames.burst):
+            self.assertTrue(verify("hash", "right"))
+
+        def busy(pwhash, password):
+            raise PoolBusy()
+
+        verify = throttle.guard(busy, "jane", "10.0.0.1")
+        for _ in range(3 * throttle.usernames.burst):
+            self.assertRaises(PoolBusy, verify, "hash", "right")
+        now = time.monotonic()
+        self.assertEqual(throttle.usernames.tokens("jane", now),
+                         throttle.usernames.burst)
+        self.assertEqual(throttle.addresses.tokens("10.0.0.1", now),
+                         throttle.addresses.burst)
+
+
+class TestRoutes(unittest.TestCase):
+    def setUp(self):
+        self.saved = {name: getattr(task_05_basic_security, name)
+                      for name in ("verify_cache", "revoked_tokens",
+                                   "hash_pool", "login_throttle")}
+        task_05_basic_security.verify_cache = VerifyCache()
+        task_05_basic_security.revoked_tokens = RevocationStore()
+        task_05_basic_security.hash_pool = HashPool()
+        task_05_basic_security.login_throttle = LoginThrottle()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        for name, value in self.saved.items():
+            setattr(task_05_basic_security, name, value)
+
+    def login(self, password="password"):
+        return self.client.post("/login", json={"username": "user1",
+                                                "password": password})
+
+    def test_claims_cache(self):
+        # Cached claims are reused until the token's exp
+        token = self.login().get_json()["access_token"]
+        headers = {"Authorization": f"Bearer {token}"}
+        misses = jwt.misses
+        for _ in range(3):
+            self.assertEqual(self.client.get("/jwt-protected",
+                                             headers=headers).status_code,
+                             200)
+        self.assertEqual(jwt.misses, misses + 1)
+        with jwt.claims_lock:
+            for digest, (exp, claims) in list(jwt.claims.items()):
+                jwt.claims[digest] = (time.time() - 1, claims)
+        self.client.get("/jwt-protected", headers=headers)
+        self.assertEqual(jwt.misses, misses + 2)
+
+    def test_claims_cache_size(self):
+        # At most size validated tokens are kept
+        size, jwt.size = jwt.size, 2
+        try:
+            for _ in range(4):
+                token = self.login().get_json()["access_token"]
+                response = self.client.get("/jwt-protected", headers={
+                    "Authorization": f"Bearer {token}"})
+                self.assertEqual(response.status_code, 200)
+                self.assertLessEqual(len(jwt.claims), 2)
+        finally:
+            jwt.size = size
+
+    def test_logout(self):
+        # A revoked token is refused, also with its claims cached
+        token = self.login().get_json()["access_token"]
+        headers = {"Authorization": f"Bearer {token}"}
+        self.assertEqual(self.client.get("/jwt-protected",
+                                         headers=headers).status_code, 200)
+        self.assertEqual(self.client.post("/logout",
+                                          headers=headers).status_code, 200)
+        response = self.client.get("/jwt-protected", headers=headers)
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response.get_json(),
+                         {"error": "Token has been revoked"})
+
+    def test_full_hash_pool(self):
+        # A login needing a hash is refused with 503 when the pool is full
+        pool = task_05_basic_security.hash_pool = HashPool(workers=1,
+                                                           queue=0)
+        pool.slots.acquire()
+        response = self.login()
+        self.assertEqual(response.status_code, 503)
+        self.assertIn("Retry-After", response.headers)
+        self.assertEqual(pool.rejected, 1)
+        pool.slots.release()
+        self.assertEqual(self.login().status_code, 200)
+
+    def test_login_lockout(self):
+        # Failed logins are throttled with 429, even the right password
+        for _ in range(task_05_basic_security.USERNAME_FAILURES[0]):
+            self.assertEqual(self.login("wrong").status_code, 401)
+        response = self.login()
+        self.assertEqual(response.status_code, 429)
+        self.assertGreater(int(response.headers["Retry-After"]), 0)
+        credentials = base64.b64encode(b"user1:password").decode()
+        response = self.client.get("/basic-protected", headers={
+            "Authorization": f"Basic {credentials}"})
+        self.assertEqual(response.status_code, 429)
+
+
+if __name__ == "__main__":
+    unittest.main()